@@ -0,0 +1,181 @@
+"""Cross-instance and cross-request batching of sentences in front of a model"""
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+logger = logging.getLogger(__file__)
+
+
+def make_batches(sentences, max_tokens=None, max_batch_size=None):
+    """
+    Splits the indexes of the tokenized sentences into batches of sentences of similar length.
+    The padded size of a batch, the number of its sentences times the length of the longest one,
+    does not exceed ``max_tokens`` unless the batch consists of a single longer sentence.
+    Without both limits all sentences form a single batch in their original order.
+    """
+    if max_tokens is None and max_batch_size is None:
+        return [list(range(len(sentences)))] if sentences else []
+    order = sorted(range(len(sentences)), key=lambda i: len(sentences[i]))
+    batches, batch = [], []
+    for i in order:
+        # the sentences are sorted, so the current one is the longest in the batch
+        padded_size = (len(batch) + 1) * len(sentences[i])
+        too_long = max_tokens is not None and padded_size > max_tokens
+        too_many = max_batch_size is not None and len(batch) >= max_batch_size
+        if batch and (too_long or too_many):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class BatchScheduler(object):
+    """
+    Collects sentences submitted by concurrent callers (paragraphs, instances and HTTP requests)
+    and processes them together.
+
+    A batching window is opened by the first pending submission and is closed either
+    after ``max_wait`` seconds or as soon as ``max_sentences`` sentences are pending.
+    The sentences of the window are split by ``make_batches``, each batch is passed to ``process_batch``,
+    a callable that returns a result per sentence, the results are scattered back to the futures of ``submit``.
+    If ``cache`` (an object with ``get_many`` and ``put_many``) is given, only the sentences missing in it
+    are processed. Repeated sentences of a window are processed once.
+    The statistics of the batches are logged at most once in ``log_interval`` seconds,
+    so the volume of the logs does not grow with the load, ``log_interval=None`` disables them.
+    """
+
+    def __init__(
+        self,
+        process_batch,
+        max_wait=0.01,
+        max_sentences=512,
+        max_tokens=None,
+        max_batch_size=None,
+        cache=None,
+        log_interval=60,
+        name="batch-scheduler",
+    ):
+        self.process_batch = process_batch
+        self.cache = cache
+        self.max_wait = max_wait
+        self.max_sentences = max_sentences
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.log_interval = log_interval
+        self.name = name
+        self._stats = self._empty_stats()
+        self._last_log_time = time.monotonic()
+        self._queue = []
+        self._pending_sentences = 0
+        self._condition = threading.Condition()
+        self._worker = threading.Thread(target=self._loop, name=name, daemon=True)
+        self._worker.start()
+
+    def submit(self, sentences):
+        """
+        Enqueues a list of tokenized sentences.
+        Returns a future that resolves to the list of their results in the same order.
+        """
+        future = Future()
+        sentences = list(sentences)
+        if not sentences:
+            future.set_result([])
+            return future
+        with self._condition:
+            self._queue.append((sentences, future))
+            self._pending_sentences += len(sentences)
+            self._condition.notify()
+        return future
+
+    def __call__(self, sentences):
+        return self.submit(sentences).result()
+
+    def _collect(self):
+        with self._condition:
+            while not self._queue:
+                self._condition.wait()
+            deadline = time.monotonic() + self.max_wait
+            while self._pending_sentences < self.max_sentences:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            requests, self._queue = self._queue, []
+            self._pending_sentences = 0
+        return requests
+
+    def _loop(self):
+        while True:
+            requests = self._collect()
+            try:
+                results = self._run([sent for sentences, _ in requests for sent in sentences])
+            except Exception as e:
+                logger.exception(f"{self.name}: batch processing failed")
+                for _, future in requests:
+                    future.set_exception(e)
+                continue
+            offset = 0
+            for sentences, future in requests:
+                future.set_result(results[offset : offset + len(sentences)])
+                offset += len(sentences)
+            self._update_stats(len(requests))
+
+    def _run(self, sentences):
+        t11 = time.time()
+        if self.cache is not None:
+            results = self.cache.get_many(sentences)
+        else:
+            results = [None] * len(sentences)
+        missing_ids = {}
+        for i, result in enumerate(results):
+            if result is None:
+                missing_ids.setdefault(tuple(sentences[i]), []).append(i)
+        missing = [list(words) for words in missing_ids]
+        missing_results = [None] * len(missing)
+        batches = make_batches(missing, self.max_tokens, self.max_batch_size)
+        for batch in batches:
+            batch_results = self.process_batch([missing[k] for k in batch])
+            for k, result in zip(batch, batch_results):
+                missing_results[k] = result
+            self._stats["padded_tokens"] += len(batch) * max(len(missing[k]) for k in batch)
+        for result, ids in zip(missing_results, missing_ids.values()):
+            for i in ids:
+                results[i] = result
+        if self.cache is not None and missing:
+            self.cache.put_many(missing, missing_results)
+        self._stats["batches"] += len(batches)
+        self._stats["sentences"] += len(sentences)
+        self._stats["processed"] += len(missing)
+        self._stats["tokens"] += sum(len(words) for words in missing)
+        self._stats["time"] += time.time() - t11
+        return results
+
+    @staticmethod
+    def _empty_stats():
+        return {
+            "windows": 0,
+            "requests": 0,
+            "batches": 0,
+            "sentences": 0,
+            "processed": 0,
+            "tokens": 0,
+            "padded_tokens": 0,
+            "time": 0.0,
+        }
+
+    def _update_stats(self, requests_number):
+        self._stats["windows"] += 1
+        self._stats["requests"] += requests_number
+        if self.log_interval is None or time.monotonic() - self._last_log_time < self.log_interval:
+            return
+        stats, self._stats = self._stats, self._empty_stats()
+        self._last_log_time = time.monotonic()
+        fill = stats["tokens"] / stats["padded_tokens"] if stats["padded_tokens"] else 0.0
+        logger.info(
+            f"{self.name}: {stats['requests']} submissions in {stats['windows']} windows, "
+            f"{stats['sentences']} sentences, {stats['processed']} processed in {stats['batches']} batches, "
+            f"padding fill {fill:.2f}, time {stats['time']:.3f}s"
+        )
@@ -0,0 +1,83 @@
+import random
+import threading
+
+from cp_batching.scheduler import BatchScheduler, make_batches
+
+
+class DictCache(object):
+    def __init__(self):
+        self.data = {}
+
+    def get_many(self, sentences):
+        return [self.data.get(tuple(words)) for words in sentences]
+
+    def put_many(self, sentences, results):
+        self.data.update((tuple(words), result) for words, result in zip(sentences, results))
+
+
+def test_make_batches():
+    rng = random.Random(0)
+    sentences = [["w"] * rng.randint(1, 30) for _ in range(200)]
+    assert make_batches(sentences) == [list(range(len(sentences)))]
+    assert make_batches([], max_tokens=10) == []
+    for max_tokens, max_batch_size in [(64, None), (None, 7), (100, 16), (5, None)]:
+        batches = make_batches(sentences, max_tokens, max_batch_size)
+        assert sorted(i for batch in batches for i in batch) == list(range(len(sentences)))
+        for batch in batches:
+            lengths = [len(sentences[i]) for i in batch]
+            assert lengths == sorted(lengths)
+            if max_batch_size is not None:
+                assert len(batch) <= max_batch_size
+            if max_tokens is not None and len(batch) > 1:
+                assert len(batch) * max(lengths) <= max_tokens
+
+
+def test_scheduler():
+    calls = []
+
+    def process_batch(batch):
+        calls.append(len(batch))
+        return [" ".join(words).upper() for words in batch]
+
+    cache = DictCache()
+    scheduler = BatchScheduler(process_batch, max_wait=0.05, max_batch_size=4, cache=cache, log_interval=None)
+    rng = random.Random(0)
+    requests = [[[rng.choice("abc") for _ in range(rng.randint(1, 5))] for _ in range(10)] for _ in range(8)]
+    results = [None] * len(requests)
+
+    def run(i):
+        results[i] = scheduler(requests[i])
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(requests))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for sentences, answer in zip(requests, results):
+        assert answer == [" ".join(words).upper() for words in sentences]
+    assert max(calls) <= 4
+    # repeated sentences are processed once, the next submission is answered from the cache
+    assert sum(calls) == len({tuple(words) for sentences in requests for words in sentences})
+    calls.clear()
+    assert scheduler(requests[0]) == results[0]
+    assert calls == []
+    assert scheduler([]) == []
+
+
+def test_scheduler_error():
+    def process_batch(batch):
+        raise ValueError("model failure")
+
+    scheduler = BatchScheduler(process_batch, max_wait=0.0, log_interval=None)
+    try:
+        scheduler([["a"]])
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("the error of the batch is not passed to the caller")
+
+
+if __name__ == "__main__":
+    test_make_batches()
+    test_scheduler()
+    test_scheduler_error()
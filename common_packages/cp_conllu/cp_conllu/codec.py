@@ -0,0 +1,129 @@
+"""
+Encodings of the sentence parses returned by morphosyntactic_parser.
+
+A parse is stored in one of the formats:
+    rows: [[id, word, lemma, upos, xpos, feats, head, deprel, deps, misc], ...], all fields are strings;
+    columns: {"form": [...], "lemma": [...], "upos": [...], "feats": [...], "head": [...], "deprel": [...]},
+        upos and deprel are given by their codes in UPOS_TAGS and DEPRELS, heads are integers,
+        the columns id, xpos, deps and misc are present only if they differ from the default ones;
+    conllu: the rows joined into a CoNLL-U string.
+The format of a parse is determined by its type, so the decoders accept any of them.
+"""
+
+FORMATS = ("rows", "columns", "conllu")
+
+# the codes are the indexes in the lists, new values are appended only
+UPOS_TAGS = "ADJ ADP ADV AUX CCONJ DET INTJ NOUN NUM PART PRON PROPN PUNCT SCONJ SYM VERB X".split()
+DEPRELS = (
+    "acl acl:relcl advcl advmod amod appos aux aux:pass case cc ccomp clf compound conj cop csubj csubj:pass "
+    "dep det discourse dislocated expl fixed flat flat:foreign flat:name goeswith iobj list mark nmod nsubj "
+    "nsubj:pass nummod nummod:entity nummod:gov obj obl obl:agent orphan parataxis punct reparandum root "
+    "vocative xcomp compound:prt det:poss nmod:poss obl:tmod nmod:tmod obl:npmod"
+).split()
+UPOS_CODES = {tag: code for code, tag in enumerate(UPOS_TAGS)}
+DEPREL_CODES = {deprel: code for code, deprel in enumerate(DEPRELS)}
+
+COLUMNS = ["id", "form", "lemma", "upos", "xpos", "feats", "head", "deprel", "deps", "misc"]
+# the columns that are omitted when all their values are "_"
+OPTIONAL_COLUMNS = ["xpos", "deps", "misc"]
+
+
+def _encode_values(values, codes):
+    # a value missing in the vocabulary is kept as a string
+    return [codes.get(value, value) for value in values]
+
+
+def _decode_values(values, vocab):
+    return [value if isinstance(value, str) else vocab[value] for value in values]
+
+
+def encode_columns(rows):
+    columns = {name: [row[i] for row in rows] for i, name in enumerate(COLUMNS)}
+    answer = {
+        "form": columns["form"],
+        "lemma": columns["lemma"],
+        "upos": _encode_values(columns["upos"], UPOS_CODES),
+        "feats": columns["feats"],
+        "head": columns["head"],
+        "deprel": _encode_values(columns["deprel"], DEPREL_CODES),
+    }
+    if all(head.isdigit() for head in columns["head"]):
+        answer["head"] = [int(head) for head in columns["head"]]
+    if columns["id"] != [str(i) for i in range(1, len(rows) + 1)]:
+        answer["id"] = columns["id"]
+    for name in OPTIONAL_COLUMNS:
+        if any(value != "_" for value in columns[name]):
+            answer[name] = columns[name]
+    return answer
+
+
+def decode_columns(columns):
+    length = len(columns["form"])
+    decoded = {
+        "id": columns.get("id") or [str(i) for i in range(1, length + 1)],
+        "form": columns["form"],
+        "lemma": columns["lemma"],
+        "upos": _decode_values(columns["upos"], UPOS_TAGS),
+        "feats": columns["feats"],
+        "head": [str(head) for head in columns["head"]],
+        "deprel": _decode_values(columns["deprel"], DEPRELS),
+    }
+    for name in OPTIONAL_COLUMNS:
+        decoded[name] = columns.get(name) or ["_"] * length
+    return [list(row) for row in zip(*(decoded[name] for name in COLUMNS))]
+
+
+def encode_conllu(rows):
+    return "\n".join("\t".join(row) for row in rows)
+
+
+def decode_conllu(text):
+    return [line.split("\t") for line in text.split("\n") if line and not line.startswith("#")]
+
+
+def encode_parse(rows, output_format="rows"):
+    """
+    Converts the rows of a sentence parse to ``output_format``.
+    """
+    if output_format == "rows":
+        return rows
+    if output_format == "columns":
+        return encode_columns(rows)
+    if output_format == "conllu":
+        return encode_conllu(rows)
+    raise ValueError(f"Unknown parse format {output_format}, use one of {FORMATS}")
+
+
+def decode_parse(parse):
+    """
+    Returns the rows of a sentence parse given in any format.
+    """
+    if isinstance(parse, dict):
+        return decode_columns(parse)
+    if isinstance(parse, str):
+        return decode_conllu(parse)
+    return parse
+
+
+def parse_to_conllu(parse):
+    """
+    Returns the CoNLL-U string of a sentence parse given in any format.
+    """
+    if isinstance(parse, str):
+        return parse
+    return encode_conllu(decode_parse(parse))
+
+
+def encode_sentences(sentences, output_format="rows"):
+    """
+    Converts the parses of ``annotated_sentences`` nested by paragraphs to ``output_format``.
+    """
+    if output_format not in FORMATS:
+        raise ValueError(f"Unknown parse format {output_format}, use one of {FORMATS}")
+    if output_format == "rows":
+        return sentences
+    return [[encode_parse(rows, output_format) for rows in paragraph] for paragraph in sentences]
+
+
+def decode_sentences(sentences):
+    return [[decode_parse(parse) for parse in paragraph] for paragraph in sentences]
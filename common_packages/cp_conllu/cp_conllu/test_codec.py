@@ -0,0 +1,51 @@
+from cp_conllu.codec import FORMATS, decode_parse, decode_sentences, encode_parse, encode_sentences, parse_to_conllu
+
+ROWS = [
+    ["1", "Пётр", "Пётр", "PROPN", "_", "Animacy=Anim|Case=Nom", "2", "nsubj", "_", "_"],
+    ["2", "основал", "основать", "VERB", "_", "Aspect=Perf", "0", "root", "_", "_"],
+    ["3", "Петербург", "Петербург", "PROPN", "_", "Case=Acc", "2", "obj", "_", "SpaceAfter=No"],
+    ["4", ".", ".", "PUNCT", "_", "_", "2", "punct", "_", "_"],
+]
+# an unknown tag and deprel, a multiword token and a non-numeric head
+UNUSUAL_ROWS = [
+    ["1-2", "во", "_", "_", "_", "_", "_", "_", "_", "_"],
+    ["1", "в", "в", "ADP", "IN", "_", "2", "case", "_", "_"],
+    ["2", "о", "о", "NEWTAG", "_", "_", "0", "new:rel", "_", "_"],
+    ["2.1", "и", "и", "CCONJ", "_", "_", "_", "_", "2:conj", "_"],
+]
+
+
+def test_round_trip():
+    for rows in [ROWS, UNUSUAL_ROWS, []]:
+        for output_format in FORMATS:
+            assert decode_parse(encode_parse(rows, output_format)) == rows, (output_format, rows)
+        assert decode_parse(parse_to_conllu(encode_parse(rows, "columns"))) == rows
+
+
+def test_columns_omit_defaults():
+    columns = encode_parse(ROWS, "columns")
+    assert set(columns) == {"form", "lemma", "upos", "feats", "head", "deprel", "misc"}
+    assert columns["head"] == [2, 0, 2, 2]
+    assert all(isinstance(code, int) for code in columns["upos"] + columns["deprel"])
+    columns = encode_parse(UNUSUAL_ROWS, "columns")
+    assert {"id", "xpos", "deps"} <= set(columns) and "misc" not in columns
+    assert columns["head"] == ["_", "2", "0", "_"]
+    assert columns["upos"][2] == "NEWTAG" and columns["deprel"][2] == "new:rel"
+
+
+def test_sentences():
+    sentences = [[ROWS, UNUSUAL_ROWS], [ROWS]]
+    for output_format in FORMATS:
+        assert decode_sentences(encode_sentences(sentences, output_format)) == sentences
+    try:
+        encode_sentences(sentences, "xml")
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("unknown format is accepted")
+
+
+if __name__ == "__main__":
+    test_round_trip()
+    test_columns_omit_defaults()
+    test_sentences()
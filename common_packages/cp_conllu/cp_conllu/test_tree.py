@@ -0,0 +1,54 @@
+from cp_conllu.codec import FORMATS, encode_parse
+from cp_conllu.tree import Tree
+
+# "Пётр Первый в 1703 году основал Петербург ."
+ROWS = [
+    ["1", "Пётр", "Пётр", "PROPN", "_", "_", "6", "nsubj", "_", "_"],
+    ["2", "Первый", "первый", "ADJ", "_", "_", "1", "amod", "_", "_"],
+    ["3", "в", "в", "ADP", "_", "_", "5", "case", "_", "_"],
+    ["4", "1703", "1703", "ADJ", "_", "_", "5", "amod", "_", "_"],
+    ["5", "году", "год", "NOUN", "_", "_", "6", "obl", "_", "_"],
+    ["6", "основал", "основать", "VERB", "_", "_", "0", "root", "_", "_"],
+    ["7", "Петербург", "Петербург", "PROPN", "_", "_", "6", "obj", "_", "_"],
+    ["8", ".", ".", "PUNCT", "_", "_", "6", "punct", "_", "_"],
+]
+
+
+def _descendants(tree, ord):
+    # the subtree by the transitive closure of the heads
+    answer = []
+    for node in tree.descendants:
+        head = tree.heads[node.ord]
+        while head >= 0:
+            if head == ord:
+                answer.append(node.ord)
+                break
+            head = tree.heads[head]
+    return answer
+
+
+def test_structure():
+    tree = Tree.from_rows(ROWS)
+    assert len(tree) == len(ROWS)
+    assert tree.root.is_root() and tree.root.parent is None
+    assert [node.ord for node in tree.root.children] == [6]
+    for node, row in zip(tree.descendants, ROWS):
+        assert (node.ord, node.form, node.lemma, node.upos, node.deprel) == (int(row[0]), *row[1:4], row[7])
+        assert node.parent.ord == int(row[6])
+        assert [child.ord for child in node.children] == [int(r[0]) for r in ROWS if r[6] == row[0]]
+    for node in tree.nodes:
+        assert [descendant.ord for descendant in node.descendants] == _descendants(tree, node.ord)
+
+
+def test_formats():
+    expected = Tree.from_rows(ROWS)
+    for output_format in FORMATS:
+        tree = Tree.from_parse(encode_parse(ROWS, output_format))
+        for attr in ["forms", "lemmas", "upos", "feats", "heads", "children"]:
+            assert getattr(tree, attr) == getattr(expected, attr), (output_format, attr)
+        assert [node.deprel for node in tree.nodes] == [node.deprel for node in expected.nodes]
+
+
+if __name__ == "__main__":
+    test_structure()
+    test_formats()
@@ -0,0 +1,139 @@
+"""
+Lightweight dependency trees of the sentence parses.
+
+The fields of the tokens are kept in per-tree arrays indexed by ``ord``, index 0 is the technical root,
+nodes are thin views over the arrays. The interface follows the used part of ``udapi.core.node.Node``:
+``ord``, ``form``, ``lemma``, ``upos``, ``feats``, ``deprel``, ``parent``, ``children`` and ``descendants``.
+"""
+from cp_conllu.codec import DEPREL_CODES, DEPRELS, UPOS_TAGS, _decode_values, _encode_values, decode_parse
+
+ROOT_LABEL = "<ROOT>"
+
+
+class Node(object):
+    __slots__ = ("tree", "ord")
+
+    def __init__(self, tree, ord):
+        self.tree = tree
+        self.ord = ord
+
+    @property
+    def form(self):
+        return self.tree.forms[self.ord]
+
+    @property
+    def lemma(self):
+        return self.tree.lemmas[self.ord]
+
+    @property
+    def upos(self):
+        return self.tree.upos[self.ord]
+
+    @property
+    def feats(self):
+        return self.tree.feats[self.ord]
+
+    @property
+    def deprel_code(self):
+        """The index of the deprel in ``DEPRELS``, the deprel itself if it is missing there"""
+        return self.tree.deprel_codes[self.ord]
+
+    @property
+    def deprel(self):
+        code = self.tree.deprel_codes[self.ord]
+        return code if isinstance(code, str) else DEPRELS[code]
+
+    @property
+    def parent(self):
+        head = self.tree.heads[self.ord]
+        return None if head < 0 else self.tree.nodes[head]
+
+    @property
+    def children(self):
+        return [self.tree.nodes[i] for i in self.tree.children[self.ord]]
+
+    @property
+    def descendants(self):
+        """All nodes of the subtree except the node itself ordered by ``ord``"""
+        if self.ord == 0:
+            return self.tree.nodes[1:]
+        ords, stack = [], list(self.tree.children[self.ord])
+        while stack:
+            i = stack.pop()
+            ords.append(i)
+            stack.extend(self.tree.children[i])
+        return [self.tree.nodes[i] for i in sorted(ords)]
+
+    def is_root(self):
+        return self.ord == 0
+
+    def __repr__(self):
+        return f"Node({self.ord}, {self.form!r}, {self.deprel!r})"
+
+
+class Tree(object):
+    """
+    Dependency tree built directly from the rows or the columns of a parse without the CoNLL-U text.
+    ``heads`` are the parent indexes (-1 for the root), ``children`` are the lists of child indexes sorted by ``ord``.
+    """
+
+    def __init__(self, forms, lemmas, upos, feats, heads, deprel_codes):
+        self.forms = [ROOT_LABEL] + list(forms)
+        self.lemmas = [ROOT_LABEL] + list(lemmas)
+        self.upos = [ROOT_LABEL] + list(upos)
+        self.feats = ["_"] + list(feats)
+        self.heads = [-1] + [int(head) for head in heads]
+        self.deprel_codes = [ROOT_LABEL] + list(deprel_codes)
+        self.children = [[] for _ in self.forms]
+        for i, head in enumerate(self.heads[1:], 1):
+            self.children[head].append(i)
+        self.nodes = [Node(self, i) for i in range(len(self.forms))]
+
+    @classmethod
+    def from_rows(cls, rows):
+        # multiword tokens and empty nodes are not the nodes of the tree
+        rows = [row for row in rows if row[0].isdigit()]
+        return cls(
+            forms=[row[1] for row in rows],
+            lemmas=[row[2] for row in rows],
+            upos=[row[3] for row in rows],
+            feats=[row[5] for row in rows],
+            heads=[row[6] for row in rows],
+            deprel_codes=_encode_values([row[7] for row in rows], DEPREL_CODES),
+        )
+
+    @classmethod
+    def from_columns(cls, columns):
+        if "id" in columns:
+            return cls.from_rows(decode_parse(columns))
+        return cls(
+            forms=columns["form"],
+            lemmas=columns["lemma"],
+            upos=_decode_values(columns["upos"], UPOS_TAGS),
+            feats=columns["feats"],
+            heads=columns["head"],
+            deprel_codes=columns["deprel"],
+        )
+
+    @classmethod
+    def from_parse(cls, parse):
+        """
+        Builds the tree of a parse in any format of ``cp_conllu.codec``.
+        """
+        if isinstance(parse, dict):
+            return cls.from_columns(parse)
+        return cls.from_rows(decode_parse(parse))
+
+    @property
+    def root(self):
+        return self.nodes[0]
+
+    @property
+    def descendants(self):
+        return self.nodes[1:]
+
+    def __len__(self):
+        return len(self.nodes) - 1
+
+    def __getitem__(self, ord):
+        return self.nodes[ord]
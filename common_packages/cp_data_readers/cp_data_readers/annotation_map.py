@@ -0,0 +1,80 @@
+"""Lazy loading of the annotation type map through a pickled snapshot"""
+import hashlib
+import json
+import os
+import pathlib
+import pickle
+import threading
+
+from cp_data_readers.utils import TypeResolver, register_type_resolver
+
+ANNOTATIONS_DATA_DIR = pathlib.Path(__file__).parent / "annotations_data"
+FULL_MAP_PATH = ANNOTATIONS_DATA_DIR / "full_map.json"
+SNAPSHOT_PATH = pathlib.Path(os.getenv("CP_FULL_MAP_SNAPSHOT", ANNOTATIONS_DATA_DIR / "full_map.pickle"))
+# change it when the structure of the snapshot or of TypeResolver is changed
+SNAPSHOT_VERSION = 2
+
+_full_map = None
+_lock = threading.Lock()
+
+
+def _get_content_hash(content):
+    return hashlib.sha256(content + str(SNAPSHOT_VERSION).encode()).hexdigest()
+
+
+def build_snapshot(full_map):
+    """
+    The map with the type resolvers of all its submaps, pickled together they share the submap objects.
+    """
+    resolvers = [TypeResolver(submap) for subject_map in full_map.values() for submap in subject_map.values()]
+    return {"full_map": full_map, "resolvers": resolvers}
+
+
+def save_snapshot(full_map_path=FULL_MAP_PATH, snapshot_path=SNAPSHOT_PATH):
+    with open(full_map_path, "rb") as fin:
+        content = fin.read()
+    snapshot = build_snapshot(json.loads(content.decode("utf8")))
+    snapshot["hash"] = _get_content_hash(content)
+    tmp_path = f"{snapshot_path}.tmp{os.getpid()}"
+    with open(tmp_path, "wb") as fout:
+        pickle.dump(snapshot, fout, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, snapshot_path)
+    return snapshot
+
+
+def load_full_map(full_map_path=FULL_MAP_PATH, snapshot_path=SNAPSHOT_PATH):
+    """
+    Loads the map from the snapshot if it is built from the current json file,
+    otherwise parses the json file and tries to save a new snapshot.
+    """
+    with open(full_map_path, "rb") as fin:
+        content_hash = _get_content_hash(fin.read())
+    snapshot = None
+    if os.path.exists(snapshot_path):
+        try:
+            with open(snapshot_path, "rb") as fin:
+                snapshot = pickle.load(fin)
+        except Exception:
+            snapshot = None
+    if snapshot is None or snapshot.get("hash") != content_hash:
+        try:
+            snapshot = save_snapshot(full_map_path, snapshot_path)
+        except OSError:
+            # the package directory can be read-only
+            with open(full_map_path, encoding="utf8") as fin:
+                snapshot = build_snapshot(json.load(fin))
+    for resolver in snapshot["resolvers"]:
+        register_type_resolver(resolver)
+    return snapshot["full_map"]
+
+
+def get_full_map():
+    """
+    Returns the map of the annotation types, it is loaded on the first call.
+    """
+    global _full_map
+    if _full_map is None:
+        with _lock:
+            if _full_map is None:
+                _full_map = load_full_map()
+    return _full_map
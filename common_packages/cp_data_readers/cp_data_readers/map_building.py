@@ -2,6 +2,7 @@ import json
 import pathlib
 
 from cp_data_readers.map_update import SUBJECT_LIST, update_full_map
+from cp_data_readers.annotation_map import save_snapshot
 from cp_data_readers.utils import clear_text, open_json
 
 
@@ -67,3 +68,5 @@ if __name__ == "__main__":
 
     with open(output_path, "w") as fout:
         json.dump(full_map, fout, ensure_ascii=False, indent=4)
+
+    save_snapshot(output_path)
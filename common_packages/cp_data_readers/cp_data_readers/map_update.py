@@ -1,6 +1,7 @@
 import json
 import pathlib
 
+from cp_data_readers.annotation_map import save_snapshot
 from cp_data_readers.utils import clear_text, open_json
 
 SUBJECT_LIST = ["русский язык", "литература", "история", "обществознание", "английский"]
@@ -48,3 +49,5 @@ if __name__ == "__main__":
 
     with open(output_path, "w") as f:
         json.dump(new_full_map, f, ensure_ascii=False, indent=4)
+
+    save_snapshot(output_path)
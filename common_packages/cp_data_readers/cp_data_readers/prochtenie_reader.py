@@ -1,9 +1,8 @@
 # -*- coding: utf-8 -*-
 
-import json
-import pathlib
 import re
 
+from cp_data_readers.annotation_map import get_full_map
 from cp_data_readers.utils import RUSSIAN_SUBJECTS, _parse_to_sentences, clear_text, find_standard_type
 from ru_sent_tokenize import ru_sent_tokenize
 
@@ -127,43 +126,121 @@ def _parse_annotation(text, subject_map):
     return parsed_annotation
 
 
-def _clear_num(text="", annotations={}, saved_num=None):
-    while re.findall(r"NUM\d\d", text):
-        current_annotations = re.findall(r"NUM\d\d", text)
-        if len(list(set(current_annotations))) == 1 and current_annotations[0] == saved_num:
-            break
-        for num in current_annotations:
-            if num != saved_num:
-                text = text.replace(num, " " + annotations[num]["text"] + " ")
+def _normalize_spaces(text):
     text = re.sub(" +", " ", text)
     text = re.sub(r'\s+([,?.!"])', r"\1", text)
     return text
 
 
+def _find_brackets(raw_essay):
+    """
+    Pairs the brackets of the essay with a stack.
+    A pair is an annotation if it is not empty and all the brackets inside it are annotations,
+    the other brackets are left in the text.
+    Returns the annotations and the top level ones, which are not nested in other annotations.
+    """
+    root = {"children": []}
+    stack = [root]
+    brackets = []
+    for i, char in enumerate(raw_essay):
+        if char == "(":
+            stack.append({"start": i, "children": []})
+        elif char == ")" and len(stack) > 1:
+            bracket = stack.pop()
+            bracket["end"] = i + 1
+            children = bracket["children"]
+            bracket["valid"] = i > bracket["start"] + 1 and all(child["valid"] for child in children)
+            bracket["height"] = 1 + max((child["height"] for child in children), default=0)
+            bracket["parent"] = stack[-1]
+            stack[-1]["children"].append(bracket)
+            brackets.append(bracket)
+    annotations, top_annotations = [], []
+    for bracket in sorted(brackets, key=lambda x: x["start"]):
+        if bracket["valid"]:
+            annotations.append(bracket)
+            # the parent is the root, an unclosed bracket or a bracket left in the text
+            if not bracket["parent"].get("valid"):
+                top_annotations.append(bracket)
+    return annotations, top_annotations
+
+
+def _replace_brackets(text, start, end, brackets):
+    """Replaces the brackets inside ``text[start:end]`` with their NUM tokens"""
+    parts = []
+    for bracket in brackets:
+        parts.append(text[start : bracket["start"]])
+        parts.append(bracket["num"])
+        start = bracket["end"]
+    parts.append(text[start:end])
+    return "".join(parts)
+
+
+def _get_nums_regexp(brackets):
+    # longer tokens go first, so that NUM100 is not matched as NUM10
+    nums = sorted((bracket["num"] for bracket in brackets), key=len, reverse=True)
+    return re.compile("|".join(nums)) if nums else None
+
+
+def _expand_nums(text, nums_regexp, annotations):
+    if nums_regexp is None:
+        return text
+    return nums_regexp.sub(lambda match: " " + annotations[match.group()]["text"] + " ", text)
+
+
+def _find_num(text, nums_regexp, num):
+    if nums_regexp is None:
+        return -1
+    return next((match.start() for match in nums_regexp.finditer(text) if match.group() == num), -1)
+
+
 def _parse_essay(raw_essay, subject_map):
-    annotations = {}
-    num_annotation = 0
-
-    while re.findall(r"\([^()]+\)", raw_essay):
-        new_brackets = re.findall(r"\([^()]+\)", raw_essay)
-        for el in new_brackets:
-            num_annotation += 1
-            parsed_dict = _parse_annotation(el[1:-1], subject_map)
-            parsed_dict["raw_text"] = el
-            num_token = "NUM" + str(num_annotation).zfill(2)
-            annotations[num_token] = parsed_dict
-            raw_essay = raw_essay.replace(el, num_token, 1)
-
-    for current_num in annotations.keys():
-        current_text = _clear_num(raw_essay, annotations, current_num)
-        annotations[current_num]["start_span"] = current_text.find(current_num)
-        annotations[current_num]["raw_text"] = _clear_num(annotations[current_num]["raw_text"], annotations)
-        annotations[current_num]["text"] = _clear_num(annotations[current_num]["text"], annotations)
-        annotations[current_num]["end_span"] = annotations[current_num]["start_span"] + len(
-            annotations[current_num]["text"]
-        )
-
-    clear_essay = _clear_num(raw_essay, annotations)
+    brackets, top_brackets = _find_brackets(raw_essay)
+    # annotations are numbered in the order of nesting depth and then of the position
+    brackets.sort(key=lambda x: (x["height"], x["start"]))
+    for num_annotation, bracket in enumerate(brackets, 1):
+        bracket["num"] = "NUM" + str(num_annotation).zfill(2)
+    essay = _replace_brackets(raw_essay, 0, len(raw_essay), top_brackets)
+    essay_nums_regexp = _get_nums_regexp(top_brackets)
+
+    # nested annotations are replaced with their NUM tokens in the text passed to the annotation parser
+    annotations, parsed_texts = {}, {}
+    for bracket in brackets:
+        current_num = bracket["num"]
+        content = _replace_brackets(raw_essay, bracket["start"] + 1, bracket["end"] - 1, bracket["children"])
+        bracket["nums_regexp"] = _get_nums_regexp(bracket["children"])
+        annotation = _parse_annotation(content, subject_map)
+        parsed_texts[current_num] = annotation["text"]
+        # the nested annotations have smaller numbers, so their texts are already cleared
+        raw_text = _expand_nums("(" + content + ")", bracket["nums_regexp"], annotations)
+        annotation["raw_text"] = _normalize_spaces(raw_text)
+        annotation["text"] = _normalize_spaces(_expand_nums(annotation["text"], bracket["nums_regexp"], annotations))
+        annotations[current_num] = annotation
+
+    # the span is the position in the essay where all other annotations are replaced with their texts,
+    # the annotations which contain the current one are replaced with their uncleared texts
+    for bracket in brackets:
+        prefix_parts = []
+        child = bracket
+        while prefix_parts is not None and child is not None:
+            parent = child["parent"] if child["parent"].get("valid") else None
+            if parent is None:
+                text, nums_regexp = essay, essay_nums_regexp
+            else:
+                text, nums_regexp = parsed_texts[parent["num"]], parent["nums_regexp"]
+            position = _find_num(text, nums_regexp, child["num"])
+            if position == -1:
+                prefix_parts = None
+            else:
+                prefix_parts.append(_expand_nums(text[:position], nums_regexp, annotations))
+            child = parent
+        annotation = annotations[bracket["num"]]
+        if prefix_parts is None:
+            annotation["start_span"] = -1
+        else:
+            annotation["start_span"] = len(_normalize_spaces(" ".join(reversed(prefix_parts))))
+        annotation["end_span"] = annotation["start_span"] + len(annotation["text"])
+
+    clear_essay = _normalize_spaces(_expand_nums(essay, essay_nums_regexp, annotations))
 
     annotations = separate_annotations(list(annotations.values()))
 
@@ -179,16 +256,13 @@ def _parse_essay(raw_essay, subject_map):
     return clear_essay, annotations
 
 
-_full_map = json.load((pathlib.Path(__file__).parent / "annotations_data" / "full_map.json").open(encoding="utf8"))
-
-
 def parse_essay(raw_essay, subject_name):
-    clear_essay, annotations = _parse_essay(raw_essay, _full_map[subject_name])
+    clear_essay, annotations = _parse_essay(raw_essay, get_full_map()[subject_name])
     return clear_essay, annotations
 
 
 def parse_text(text_lines, full_map=None):
-    full_map = _full_map if full_map is None else full_map
+    full_map = get_full_map() if full_map is None else full_map
     attr_dict = {}
 
     previous_section = ""
@@ -264,7 +338,7 @@ def parse_text(text_lines, full_map=None):
     if attr_dict["эссе"].startswith("\n"):
         attr_dict["эссе"] = attr_dict["эссе"][1:]
 
-    subject_map = _full_map[attr_dict["предмет"]]
+    subject_map = get_full_map()[attr_dict["предмет"]]
     clear_essay, annotations = _parse_essay(attr_dict["эссе"], subject_map)
 
     clear_essay = re.sub(" +", " ", clear_essay)
@@ -0,0 +1,58 @@
+import re
+
+from cp_data_readers.annotation_map import get_full_map
+from cp_data_readers.prochtenie_reader import _expand_nums, _find_brackets, _parse_essay
+
+NESTED_ESSAY = "Пётр (\\и.событие\\ основал (*\\и.сяп\\ город >> города :: коммент \\)) в 1703 году."
+LINKED_ESSAY = "Начало (\\и.период\\ (\\и.событие\\ вложенная) внешняя) конец (*\\и.сяп\\ связь #1 #ссылка\\)."
+
+
+def test_find_brackets():
+    text = "a (b (c) d) () e) (f (g"
+    annotations, top_annotations = _find_brackets(text)
+    assert [text[bracket["start"] : bracket["end"]] for bracket in annotations] == ["(b (c) d)", "(c)"]
+    assert [bracket["start"] for bracket in top_annotations] == [2]
+    assert [bracket["height"] for bracket in annotations] == [2, 1]
+    # an empty pair is left in the text, so the pair containing it is not an annotation too
+    annotations, top_annotations = _find_brackets("(a () b) (c)")
+    assert [(bracket["start"], bracket["end"]) for bracket in annotations] == [(9, 12)]
+    assert annotations == top_annotations
+
+
+def test_expand_nums():
+    annotations = {"NUM01": {"text": "город"}, "NUM02": {"text": "основал NUM01"}}
+    nums_regexp = re.compile("NUM01|NUM02")
+    assert _expand_nums("Пётр NUM02.", nums_regexp, annotations) == "Пётр  основал NUM01 ."
+    assert _expand_nums("NUM01NUM01", nums_regexp, annotations) == " город  город "
+    assert _expand_nums("NUM03", None, annotations) == "NUM03"
+
+
+def test_parse_essay():
+    subject_map = get_full_map()["история"]
+    clear_essay, annotations = _parse_essay(NESTED_ESSAY, subject_map)
+    assert clear_essay == "Пётр основал город в 1703 году."
+    assert annotations["sections"] == []
+    assert [
+        (mistake["raw_type"], mistake["text"], mistake["start_span"], mistake["end_span"])
+        for mistake in annotations["mistakes"]
+    ] == [("и.сяп", "город ", 13, 19), ("и.событие", "основал город ", 5, 19)]
+    assert annotations["mistakes"][0]["corrected_text"] == " города "
+    assert annotations["mistakes"][0]["comment"] == "коммент"
+    assert annotations["mistakes"][1]["raw_text"] == "(\\и.событие\\ основал город )"
+
+    clear_essay, annotations = _parse_essay(LINKED_ESSAY, subject_map)
+    assert clear_essay == "Начало вложенная внешняя конец связь."
+    assert [
+        (mistake["raw_type"], mistake["start_span"], mistake["end_span"]) for mistake in annotations["mistakes"]
+    ] == [("и.событие", 7, 16), ("и.сяп", 31, 36), ("и.период", 7, 25)]
+    assert annotations["mistakes"][1]["link"] == ["#1"]
+    assert annotations["mistakes"][1]["link_text"] == ["#ссылка"]
+
+    text = "Скобки (без аннотации) и () пустые ) остаются."
+    assert _parse_essay(text, subject_map) == (text, {"sections": [], "mistakes": []})
+
+
+if __name__ == "__main__":
+    test_find_brackets()
+    test_expand_nums()
+    test_parse_essay()
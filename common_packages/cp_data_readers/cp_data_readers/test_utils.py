@@ -0,0 +1,90 @@
+import json
+import pathlib
+import random
+
+import nltk
+
+from cp_data_readers.utils import TypeResolver, _word_tokenize, clear_text, find_closest_type
+
+MAP_PATH = pathlib.Path(__file__).parent / "annotations_data" / "full_map.json"
+
+WORD_TOKENIZATION = {
+    "It's a well-known fact, isn't it?!": (
+        ["It's", "a", "well-known", "fact", ",", "isn't", "it", "?", "!"],
+        [0, 5, 7, 18, 22, 24, 30, 32, 33],
+    ),
+    "Don't -- stop... Wait!!": (["Don't", "-", "-", "stop", "...", "Wait", "!", "!"], [0, 6, 7, 9, 13, 17, 21, 22]),
+    "Пётр I -- основатель Санкт-Петербурга.": (
+        ["Пётр", "I", "-", "-", "основатель", "Санкт-Петербурга", "."],
+        [0, 5, 7, 8, 10, 21, 37],
+    ),
+    "rock'n'roll ''quoted'' 've": (["rock'n", "'", "roll", "''", "quoted", "'", "''ve"], [0, 6, 7, 12, 14, 20, 21]),
+    "- dash at start -": (["-", "dash", "at", "start", "-"], [0, 2, 7, 10, 16]),
+    "x-y-z...?": (["x-y", "-", "z", ".", ".", ".", "?"], [0, 3, 4, 5, 6, 7, 8]),
+    "": ([], []),
+}
+
+
+def _linear_find_standard_type(raw_type, submap):
+    # the scan over the submap replaced by TypeResolver
+    clean_type = clear_text(raw_type)
+    if clean_type == "":
+        return ""
+    if clean_type in submap:
+        return submap[clean_type]
+    for standard_raw_type in submap:
+        if (clean_type in standard_raw_type or standard_raw_type in clean_type) and len(clean_type) > 2:
+            return submap[standard_raw_type]
+    return find_closest_type(clean_type, submap)
+
+
+def _random_types(types, rng, number):
+    alphabet = "абвгдежзиклмнопрстуфхцчшщыэюяabcdefgh.-1234 "
+    for _ in range(number):
+        r = rng.random()
+        if r < 0.5:
+            chars = list(rng.choice(types))
+            for _ in range(rng.randint(0, 4)):
+                position = rng.randrange(len(chars) + 1)
+                if rng.random() < 0.4 and chars:
+                    del chars[min(position, len(chars) - 1)]
+                else:
+                    chars.insert(position, rng.choice(alphabet))
+            yield "".join(chars).upper() if rng.random() < 0.3 else "".join(chars)
+        elif r < 0.7:
+            yield rng.choice(types) + rng.choice(["", " x", "ка", ".1"])
+        else:
+            yield "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 12)))
+
+
+def test_type_resolver():
+    with MAP_PATH.open(encoding="utf8") as fin:
+        full_map = json.load(fin)
+    rng = random.Random(0)
+    for subject_map in full_map.values():
+        for submap in [subject_map["sections"], subject_map["mistakes"]]:
+            resolver = TypeResolver(submap)
+            for raw_type in _random_types(list(submap), rng, 300):
+                try:
+                    expected = _linear_find_standard_type(raw_type, submap)
+                except IndexError:
+                    # common_substring fails on one-character types
+                    continue
+                assert resolver(raw_type) == expected, raw_type
+
+
+def test_word_tokenize():
+    for text, expected in WORD_TOKENIZATION.items():
+        assert _word_tokenize(text) == expected, text
+    tokenizer = nltk.tokenize.WordPunctTokenizer()
+    for text in WORD_TOKENIZATION:
+        for flag in ["postprocess_hyphens", "postprocess_apostrophs", "postprocess_long_punctuation"]:
+            for value in [True, False]:
+                # the regexp of the default tokenizer and the explicit one give the same words
+                answer = _word_tokenize(text, tokenizer=tokenizer, **{flag: value})
+                assert answer == _word_tokenize(text, **{flag: value}), (text, flag)
+
+
+if __name__ == "__main__":
+    test_type_resolver()
+    test_word_tokenize()
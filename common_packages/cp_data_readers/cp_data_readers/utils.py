@@ -1,6 +1,7 @@
+import functools
 import json
 import re
-from collections import Counter
+from collections import Counter, defaultdict, deque
 from itertools import chain
 from string import punctuation
 
@@ -66,19 +67,116 @@ def common_substring(str1, str2, n):
     return common_substrings
 
 
-def find_standard_type(raw_type, submap):
-    standard_raw_types = list(submap.keys())
-    clean_type = clear_text(raw_type)
-    if clean_type == "":
-        return ""
-    if clean_type not in standard_raw_types:
-        for standard_raw_type in standard_raw_types:
-            if (clean_type in standard_raw_type or standard_raw_type in clean_type) and len(clean_type) > 2:
-                return submap[standard_raw_type]
-        closest_standard_type = find_closest_type(clean_type, submap)
+def _ngrams(text, n):
+    return {text[i : i + n] for i in range(len(text) - n + 1)}
+
+
+class TypeResolver:
+    """
+    Precomputed ``find_standard_type`` for one submap, the submap should not be changed after the resolver is built.
+    Candidates are taken from the n-gram index of the standard raw types and from the types of close lengths,
+    then they are checked in the order of the submap as in the linear scans, so the results are the same.
+    The results of the last ``cache_size`` distinct types are cached.
+    """
+
+    NGRAM_SIZE = 3
+    CACHE_SIZE = 10000
+
+    def __init__(self, submap, cache_size=CACHE_SIZE):
+        self.submap = submap
+        self.standard_raw_types = list(submap.keys())
+        self.type_ids = {standard_raw_type: i for i, standard_raw_type in enumerate(self.standard_raw_types)}
+        self.profiles = [Counter(standard_raw_type) for standard_raw_type in self.standard_raw_types]
+        self.ngram_index = defaultdict(set)
+        self.length_index = defaultdict(set)
+        for i, standard_raw_type in enumerate(self.standard_raw_types):
+            for ngram in _ngrams(standard_raw_type, self.NGRAM_SIZE):
+                self.ngram_index[ngram].add(i)
+            self.length_index[len(standard_raw_type)].add(i)
+        self.cache_size = cache_size
+        self._init_cache()
+
+    def _init_cache(self):
+        # the raw types come from the user input, so the cache is bounded
+        self._cached_find_standard_type = functools.lru_cache(maxsize=self.cache_size)(self._find_standard_type)
+
+    def __getstate__(self):
+        # the cache is not pickled with the snapshot of the annotation map
+        state = self.__dict__.copy()
+        del state["_cached_find_standard_type"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_cache()
+
+    def __call__(self, raw_type):
+        return self._cached_find_standard_type(clear_text(raw_type))
+
+    def _find_standard_type(self, clean_type):
+        if clean_type == "":
+            return ""
+        if clean_type in self.submap:
+            return self.submap[clean_type]
+        if len(clean_type) > 2:
+            # the first standard raw type, which is a substring of the type or contains it
+            ids = {
+                self.type_ids[clean_type[i:j]]
+                for i in range(len(clean_type))
+                for j in range(i + 1, len(clean_type) + 1)
+                if clean_type[i:j] in self.type_ids
+            }
+            ngram_ids = [self.ngram_index.get(ngram, set()) for ngram in _ngrams(clean_type, self.NGRAM_SIZE)]
+            ids.update(i for i in set.intersection(*ngram_ids) if clean_type in self.standard_raw_types[i])
+            if ids:
+                return self.submap[self.standard_raw_types[min(ids)]]
+        return self._find_closest_type(clean_type)
+
+    def _find_closest_type(self, clean_type):
+        # a common substring longer than NGRAM_SIZE - 1 has a common n-gram,
+        # the proximity is not above 0.8 for the types of too different lengths
+        candidates = set()
+        for ngram in _ngrams(clean_type, self.NGRAM_SIZE):
+            candidates.update(self.ngram_index.get(ngram, set()))
+        for length, ids in self.length_index.items():
+            common_substring_length = (len(clean_type) + length) // 4
+            length_proximity = 2 * min(len(clean_type), length) / (len(clean_type) + length)
+            if common_substring_length < self.NGRAM_SIZE or length_proximity > 0.8:
+                candidates.update(ids)
+        profile = Counter(clean_type)
+        max_proximity = 0
+        closest_standard_type = ""
+        for i in sorted(candidates):
+            standard_raw_type = self.standard_raw_types[i]
+            common_characters = sum((profile & self.profiles[i]).values())
+            current_proximity = 2 * common_characters / (len(clean_type) + len(standard_raw_type))
+            if (current_proximity > max_proximity and current_proximity > 0.8) or common_substring(
+                clean_type, standard_raw_type, (len(clean_type) + len(standard_raw_type)) // 4
+            ):
+                max_proximity = current_proximity
+                closest_standard_type = self.submap[standard_raw_type]
         return closest_standard_type
-    else:
-        return submap[clean_type]
+
+
+_type_resolvers = {}
+
+
+def register_type_resolver(resolver):
+    """Makes ``find_standard_type`` use a prebuilt resolver for its submap"""
+    _type_resolvers[id(resolver.submap)] = resolver
+
+
+def get_type_resolver(submap):
+    """
+    Returns the resolver of the submap, resolvers are built once per submap object.
+    """
+    if id(submap) not in _type_resolvers or _type_resolvers[id(submap)].submap is not submap:
+        _type_resolvers[id(submap)] = TypeResolver(submap)
+    return _type_resolvers[id(submap)]
+
+
+def find_standard_type(raw_type, submap):
+    return get_type_resolver(submap)(raw_type)
 
 
 # ===========================
@@ -130,6 +228,61 @@ def sent_tokenize(text, tokenizer=None):
     return answer
 
 
+# the pattern of nltk.tokenize.WordPunctTokenizer
+WORD_PUNCT_REGEXP = re.compile(r"\w+|[^\w\s]+", re.UNICODE | re.MULTILINE | re.DOTALL)
+
+
+def _merge_hyphens(text, spans):
+    """
+    Joins a word, a hyphen and a word written without spaces.
+    As before, a triple is joined only if there is one more word after it.
+    """
+    window = deque()
+    for span in spans:
+        window.append(span)
+        if len(window) < 4:
+            continue
+        (word, start), (hyphen, _), (next_word, next_start) = window[0], window[1], window[2]
+        if hyphen == "-" and text[start:next_start] == word + hyphen:
+            yield word + hyphen + next_word, start
+            for _ in range(3):
+                window.popleft()
+        else:
+            yield window.popleft()
+    yield from window
+
+
+def _split_long_punctuation(spans):
+    for word, start in spans:
+        if len(word) > 1 and not all(x == "." for x in word) and is_punctuation(word):
+            yield from ((char, start + j) for j, char in enumerate(word))
+        else:
+            yield word, start
+
+
+def _merge_apostrophes(spans):
+    """
+    Joins a word with the following apostrophe and with the lowercase suffix of at most 2 letters after it.
+    """
+    window = deque()
+    for span in spans:
+        window.append(span)
+        if len(window) < 3:
+            continue
+        (word, start), (apostrophe, _), (suffix, _) = window
+        if apostrophe == "'" and suffix[0].islower():
+            if len(suffix) <= 2:
+                yield word + apostrophe + suffix, start
+                window.clear()
+            else:
+                yield word + apostrophe, start
+                window.popleft()
+                window.popleft()
+        else:
+            yield window.popleft()
+    yield from window
+
+
 def _word_tokenize(
     text,
     tokenizer=None,
@@ -138,46 +291,26 @@ def _word_tokenize(
     postprocess_apostrophs=True,
     postprocess_long_punctuation=True,
 ):
-    tokenizer = tokenizer or nltk.tokenize.WordPunctTokenizer()
-    words = tokenizer.tokenize(text)
-    word_offsets = find_offsets(text, words, start=start_offset)
+    """
+    Returns the words of the text and their offsets.
+    The words are streamed from the tokenizer through the postprocessing steps in a single pass.
+    """
+    if tokenizer is None and start_offset == 0:
+        spans = ((match.group(), match.start()) for match in WORD_PUNCT_REGEXP.finditer(text))
+    else:
+        tokenizer = tokenizer or nltk.tokenize.WordPunctTokenizer()
+        words = tokenizer.tokenize(text)
+        spans = zip(words, find_offsets(text, words, start=start_offset))
     if postprocess_hyphens:
-        new_word_indexes, i = [], 0
-        while i < len(words):
-            if i < len(words) - 3 and words[i + 1] == "-":  #  and words[i+2].islower():
-                if "".join(words[i : i + 2]) == text[word_offsets[i] : word_offsets[i + 2]]:
-                    new_word_indexes.append(i)
-                    i += 3
-                    continue
-            new_word_indexes.append(i)
-            i += 1
-        new_word_indexes.append(len(words))
-        words = ["".join(words[start:end]) for start, end in zip(new_word_indexes[:-1], new_word_indexes[1:])]
-        word_offsets = [word_offsets[i] for i in new_word_indexes[:-1]]
+        spans = _merge_hyphens(text, spans)
     if postprocess_long_punctuation:
-        new_word_offsets, new_words = [], []
-        for i, word in enumerate(words):
-            if len(word) > 1 and not all(x == "." for x in word) and is_punctuation(word):
-                new_words.extend(word)
-                new_word_offsets.extend(word_offsets[i] + j for j in range(len(word)))
-            else:
-                new_words.append(word)
-                new_word_offsets.append(word_offsets[i])
-        words, word_offsets = new_words, new_word_offsets
+        spans = _split_long_punctuation(spans)
     if postprocess_apostrophs:
-        new_word_indexes, i = [], 0
-        while i < len(words):
-            new_word_indexes.append(i)
-            if i + 1 < len(words) and is_apostrophe(words, i + 1):
-                if len(words[i + 2]) <= 2:
-                    i += 3
-                else:
-                    i += 2
-            else:
-                i += 1
-        new_word_indexes.append(len(words))
-        words = ["".join(words[i:j]) for i, j in zip(new_word_indexes[:-1], new_word_indexes[1:])]
-        word_offsets = [word_offsets[i] for i in new_word_indexes[:-1]]
+        spans = _merge_apostrophes(spans)
+    words, word_offsets = [], []
+    for word, offset in spans:
+        words.append(word)
+        word_offsets.append(offset)
     return words, word_offsets
 
 
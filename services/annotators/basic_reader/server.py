@@ -12,19 +12,33 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import logging
+import multiprocessing
 import os
+import shutil
+import tempfile
+import threading
 import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 
 from cp_data_readers import json_prochtenie_reader, neznaika_reader
 from cp_data_store import store
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request, stream_with_context
 from healthcheck import HealthCheck
 
 SERVICE_NAME = os.getenv("SERVICE_NAME", "unknow_skill")
 SERVICE_PORT = int(os.getenv("SERVICE_PORT", 3000))
 STORE_DATA_ENABLE = bool(os.getenv("STORE_DATA_ENABLE", False))
 INPUT_DATA_FILE = "server_input_data.jsonl"
+BULK_WORKERS = int(os.getenv("BASIC_READER_BULK_WORKERS", os.cpu_count() or 1))
+# the number of instances submitted to the pool and not yet streamed back, bounds the memory of a bulk request
+BULK_MAX_PENDING = int(os.getenv("BASIC_READER_BULK_MAX_PENDING", 4 * BULK_WORKERS))
+# an NDJSON body larger than this is spooled to a temporary file instead of the memory
+BULK_SPOOL_MAX_SIZE = int(os.getenv("BASIC_READER_BULK_SPOOL_MAX_SIZE", 16 * 1024 * 1024))
+# the number of instances of a bulk request saved as one line of INPUT_DATA_FILE
+BULK_STORE_CHUNK = 1000
 
 
 logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
@@ -47,10 +61,147 @@ def handler(instance):
     elif "prochtenie" == instance["instance_info"]["dataset_name"]:
         parsed_text = json_prochtenie_reader.parse_text(raw_input)
     else:
-        raise "not implemented"
+        raise NotImplementedError(f"unknown dataset {instance['instance_info']['dataset_name']}")
     return parsed_text
 
 
+def timed_handler(instance):
+    """
+    Runs ``handler`` in a pool process, an error is returned instead of being raised
+    so that one broken instance does not fail the whole bulk request.
+    """
+    st_time = time.time()
+    try:
+        return {"result": handler(instance), "time": time.time() - st_time}
+    except Exception as e:
+        logger.exception("Instance parsing failed")
+        return {"error": f"{type(e).__name__}: {e}", "time": time.time() - st_time}
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    The pool is created lazily by a request thread of gunicorn,
+    so its workers are started by a forkserver instead of forking the multithreaded process.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=BULK_WORKERS, mp_context=multiprocessing.get_context("forkserver"))
+    return _pool
+
+
+def reset_pool(pool):
+    """
+    Drops a broken pool, e.g. after a worker process was killed, so that the next submission creates a new one.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+
+def submit_instance(instance):
+    """
+    Returns the future of ``timed_handler`` and the pool that runs it.
+    """
+    pool = get_pool()
+    try:
+        return pool.submit(timed_handler, instance), pool
+    except BrokenProcessPool:
+        reset_pool(pool)
+        pool = get_pool()
+        return pool.submit(timed_handler, instance), pool
+
+
+def get_bulk_response(future, pool):
+    try:
+        return future.result()
+    except Exception as e:
+        logger.exception("Instance parsing failed")
+        if isinstance(e, BrokenProcessPool):
+            reset_pool(pool)
+        return {"error": f"{type(e).__name__}: {e}", "time": None}
+
+
+def spool_bulk_body():
+    """
+    Reads the whole NDJSON body before the results are streamed back.
+    Clients which send the whole body before reading the response (``requests``, ``urllib``) would deadlock
+    otherwise: the unread result lines fill the socket buffers and the server stops reading the body.
+    """
+    body = tempfile.SpooledTemporaryFile(max_size=BULK_SPOOL_MAX_SIZE)
+    shutil.copyfileobj(request.stream, body)
+    body.seek(0)
+    return body
+
+
+def iter_bulk_instances(body):
+    """
+    Yields the instances of a bulk request: either the spooled NDJSON ``body`` with an instance per line
+    or a usual json with ``input_data`` if ``body`` is None.
+    A line that is not a valid json is yielded as an ``{"error": ...}`` response instead of the instance.
+    """
+    if body is not None:
+        for line in body:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line), None
+            except ValueError as e:
+                yield None, {"error": f"{type(e).__name__}: {e}", "time": None}
+    else:
+        for instance in request.json["input_data"]:
+            yield instance, None
+
+
+def store_bulk_instances(instances):
+    """
+    Saves the instances of a bulk request to ``INPUT_DATA_FILE`` in the format of ``/model`` requests,
+    ``BULK_STORE_CHUNK`` instances per line, and passes them through.
+    """
+    chunk = []
+    for instance, error in instances:
+        if error is None:
+            chunk.append(instance)
+            if len(chunk) == BULK_STORE_CHUNK:
+                store.save2json_line({"input_data": chunk}, INPUT_DATA_FILE)
+                chunk = []
+        yield instance, error
+    if chunk:
+        store.save2json_line({"input_data": chunk}, INPUT_DATA_FILE)
+
+
+def parse_bulk(instances):
+    """
+    Parses the instances in the process pool and yields ``(index, response)`` in the order of completion.
+    ``instances`` are ``(instance, error)`` pairs of ``iter_bulk_instances``, the errors are yielded as they are.
+    """
+    pending = {}
+    for index, (instance, error) in enumerate(instances):
+        if error is not None:
+            yield index, error
+            continue
+        future, pool = submit_instance(instance)
+        pending[future] = index, pool
+        while len(pending) >= BULK_MAX_PENDING:
+            yield from _pop_completed(pending)
+    while pending:
+        yield from _pop_completed(pending)
+
+
+def _pop_completed(pending):
+    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+    for future in done:
+        index, pool = pending.pop(future)
+        yield index, get_bulk_response(future, pool)
+
+
 @app.route("/model", methods=["POST"])
 def respond():
     """A handler of requests.
@@ -71,5 +222,37 @@ def respond():
     return jsonify(responses)
 
 
+@app.route("/bulk", methods=["POST"])
+def respond_bulk():
+    """A handler of large batches of instances.
+    The results are streamed back as NDJSON lines in the order of completion,
+    each line has the ``index`` of the instance, its ``time`` and either ``result`` or ``error``.
+    The NDJSON body is read completely before the first result is sent.
+    To use:
+    curl -X POST "http://localhost:${PORT}/bulk" \
+    -H "Content-Type: application/x-ndjson" --data-binary @instances.jsonl
+    """
+    body = spool_bulk_body() if request.mimetype == "application/x-ndjson" else None
+    instances = iter_bulk_instances(body)
+    if STORE_DATA_ENABLE:
+        instances = store_bulk_instances(instances)
+
+    def generate():
+        st_time = time.time()
+        count, errors = 0, 0
+        try:
+            for index, response in parse_bulk(instances):
+                count += 1
+                errors += "error" in response
+                yield json.dumps({"index": index, **response}, ensure_ascii=False) + "\n"
+        finally:
+            if body is not None:
+                body.close()
+        total_time = time.time() - st_time
+        logger.info(f"{SERVICE_NAME} bulk exec time: {total_time:.3f}s, {count} instances, {errors} errors")
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
 if __name__ == "__main__":
     app.run(debug=True, host="0.0.0.0", port=SERVICE_PORT)
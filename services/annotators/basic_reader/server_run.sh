@@ -1,3 +1,3 @@
 while ! pip install -r common_requirements.txt ; do sleep 5; done
 
-gunicorn --workers=1 server:app -b 0.0.0.0:${SERVICE_PORT} --reload --timeout 120
+gunicorn --workers=1 --threads=${BASIC_READER_THREADS:-4} server:app -b 0.0.0.0:${SERVICE_PORT} --reload --timeout 120
@@ -0,0 +1,95 @@
+"""Content-addressed cache of the sentence parses"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+def get_config_fingerprint(config, **params):
+    """
+    Hash of the parsed DeepPavlov config and of the parameters that change the output of the parser.
+    """
+    data = json.dumps([config, params], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(data.encode("utf8")).hexdigest()
+
+
+class ParseCache(object):
+    """
+    Two-tier cache of the CoNLL-U rows of sentences: an in-process LRU and an optional SQLite database on disk.
+    A key depends on the words of the sentence and on the fingerprint of the parser config,
+    so the cache stays valid across restarts and is not reused after the model is changed.
+    """
+
+    def __init__(self, fingerprint, maxsize=100000, db_path=None):
+        self.fingerprint = fingerprint
+        self.maxsize = maxsize
+        self.db_path = db_path
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._connection = None
+        if db_path:
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+            self._connection = sqlite3.connect(db_path, check_same_thread=False)
+            self._connection.execute("CREATE TABLE IF NOT EXISTS parses (key TEXT PRIMARY KEY, value TEXT)")
+            self._connection.commit()
+
+    def make_key(self, words):
+        data = json.dumps([self.fingerprint, list(words)], ensure_ascii=False)
+        return hashlib.sha1(data.encode("utf8")).hexdigest()
+
+    def _remember(self, key, parse):
+        self._memory[key] = parse
+        self._memory.move_to_end(key)
+        if len(self._memory) > self.maxsize:
+            self._memory.popitem(last=False)
+
+    def get_many(self, sentences):
+        """
+        Returns cached parses of the sentences, ``None`` for the sentences that are not cached.
+        """
+        keys = [self.make_key(words) for words in sentences]
+        parses = [None] * len(keys)
+        with self._lock:
+            for i, key in enumerate(keys):
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    parses[i] = self._memory[key]
+                    self.hits += 1
+                elif self._connection is not None:
+                    row = self._connection.execute("SELECT value FROM parses WHERE key = ?", (key,)).fetchone()
+                    if row is not None:
+                        parses[i] = json.loads(row[0])
+                        self._remember(key, parses[i])
+                        self.disk_hits += 1
+                    else:
+                        self.misses += 1
+                else:
+                    self.misses += 1
+        return parses
+
+    def put_many(self, sentences, parses):
+        rows = []
+        with self._lock:
+            for words, parse in zip(sentences, parses):
+                key = self.make_key(words)
+                self._remember(key, parse)
+                rows.append((key, json.dumps(parse, ensure_ascii=False)))
+            if self._connection is not None:
+                self._connection.executemany("INSERT OR REPLACE INTO parses VALUES (?, ?)", rows)
+                self._connection.commit()
+
+    def stats(self):
+        requests = self.hits + self.disk_hits + self.misses
+        return {
+            "size": len(self._memory),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / requests if requests else 0.0,
+        }
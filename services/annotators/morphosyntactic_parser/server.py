@@ -17,11 +17,15 @@ import logging
 import os
 import time
 
+from cp_batching.scheduler import BatchScheduler
+from cp_conllu.codec import FORMATS, encode_sentences
 from cp_data_readers.utils import RUSSIAN_SUBJECTS
 from cp_data_store import store
 from deeppavlov import build_model
+from deeppavlov.core.commands.utils import parse_config
 from flask import Flask, jsonify, request
 from healthcheck import HealthCheck
+from parse_cache import ParseCache, get_config_fingerprint
 
 SERVICE_NAME = os.getenv("SERVICE_NAME", "unknow_skill")
 SERVICE_PORT = int(os.getenv("SERVICE_PORT", 3000))
@@ -29,6 +33,9 @@ DEEPPAVLOV_CONFIG = os.getenv("DEEPPAVLOV_CONFIG")
 MODEL_LANGUAGE = os.getenv("MODEL_LANGUAGE", "russian")
 STORE_DATA_ENABLE = bool(os.getenv("STORE_DATA_ENABLE", False))
 INPUT_DATA_FILE = "server_input_data.jsonl"
+# the format of the parses in the response: rows, columns or conllu, see cp_conllu.codec
+OUTPUT_FORMAT = os.getenv("PARSER_OUTPUT_FORMAT", "rows")
+assert OUTPUT_FORMAT in FORMATS, f"PARSER_OUTPUT_FORMAT should be one of {FORMATS}"
 
 
 logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
@@ -41,8 +48,41 @@ parser = build_model(DEEPPAVLOV_CONFIG)
 parser["main"].to_output_string = False
 SUBJECTS = ["английский"] if MODEL_LANGUAGE == "english" else RUSSIAN_SUBJECTS
 
+parse_cache_size = int(os.getenv("PARSER_CACHE_SIZE", 100000))
+parse_cache = None
+if parse_cache_size:
+    fingerprint = get_config_fingerprint(parse_config(DEEPPAVLOV_CONFIG), to_output_string=False)
+    parse_cache = ParseCache(fingerprint, maxsize=parse_cache_size, db_path=os.getenv("PARSER_CACHE_DB"))
 
-def handler(instance):
+scheduler = BatchScheduler(
+    lambda batch: parser.batched_call(batch, batch_size=len(batch)),
+    cache=parse_cache,
+    max_wait=float(os.getenv("PARSER_BATCH_WAIT", 0.01)),
+    max_sentences=int(os.getenv("PARSER_MAX_PENDING_SENTENCES", 512)),
+    max_tokens=int(os.getenv("PARSER_MAX_BATCH_TOKENS", 4096)),
+    max_batch_size=int(os.getenv("PARSER_MAX_BATCH_SIZE", 64)),
+    log_interval=float(os.getenv("PARSER_LOG_INTERVAL", 60)),
+    name="parse-scheduler",
+)
+
+
+def is_supported(instance):
+    return instance["instance_info"]["subject"] in SUBJECTS
+
+
+def submit_instance(instance):
+    """
+    Enqueues all sentences of the instance to the parse scheduler,
+    so that sentences of all instances and concurrent requests are parsed together.
+    """
+    if not is_supported(instance):
+        return None
+    sents = instance["annotations"]["basic_reader"]["clear_essay_sentences"]
+    # we use `words` field to keep tokenization
+    return scheduler.submit(elem["words"] for elem in itertools.chain.from_iterable(sents))
+
+
+def handler(instance, parses_future, output_format=OUTPUT_FORMAT):
     """
     Calculates the annotation of the format
     [[parse_11, parse_12, ...], ...]
@@ -52,21 +92,20 @@ def handler(instance):
     Each parse is a list of lists of the form
         [[1, word, lemma, upos, _, feats, parent, deprel, _, _], ...]
     Each internal list contains 10 fields describing a particular token.
+    The parses are encoded to ``output_format`` by ``cp_conllu.codec.encode_sentences``.
     """
 
-    if instance["instance_info"]["subject"] not in SUBJECTS:
+    if parses_future is None:
         return {"annotated_sentences": []}
     sents = instance["annotations"]["basic_reader"]["clear_essay_sentences"]
     parsed_sents = [[None] * len(elem) for elem in sents]
-    # we use `words` field to keep tokenization
-    data_to_parse = list(elem["words"] for elem in itertools.chain.from_iterable(sents))
-    parses = parser.batched_call(data_to_parse)
+    parses = parses_future.result()
     index = 0
     for i, paragraph in enumerate(sents):
         for j, _ in enumerate(paragraph):
             parsed_sents[i][j] = parses[index]
             index += 1
-    return {"annotated_sentences": parsed_sents}
+    return {"annotated_sentences": encode_sentences(parsed_sents, output_format)}
 
 
 @app.route("/model", methods=["POST"])
@@ -79,13 +118,24 @@ def respond():
     """
     st_time = time.time()
 
+    output_format = request.json.get("output_format", OUTPUT_FORMAT)
+    if output_format not in FORMATS:
+        return jsonify({"error": f"Unknown output_format {output_format}, use one of {FORMATS}"}), 400
     if STORE_DATA_ENABLE:
         store.save2json_line(request.json, INPUT_DATA_FILE)
-    responses = [handler(instance) for instance in request.json["input_data"]]
+    input_data = request.json["input_data"]
+    futures = [submit_instance(instance) for instance in input_data]
+    responses = [handler(instance, future, output_format) for instance, future in zip(input_data, futures)]
     total_time = time.time() - st_time
     logger.info(f"{SERVICE_NAME} exec time: {total_time:.3f}s")
     return jsonify(responses)
 
 
+@app.route("/cache_stats", methods=["GET"])
+def cache_stats():
+    """Hit rates of the parse cache"""
+    return jsonify(parse_cache.stats() if parse_cache is not None else None)
+
+
 if __name__ == "__main__":
     app.run(debug=True, host="0.0.0.0", port=SERVICE_PORT)
@@ -0,0 +1,41 @@
+"""
+Warms the parse cache with the sentences of the requests saved with ``STORE_DATA_ENABLE``.
+The parses are saved to ``PARSER_CACHE_DB``, so they are reused by the running service.
+To use:
+    PARSER_CACHE_DB=/root/.cache/parser/parses.sqlite python warm_cache.py [path/to/server_input_data.jsonl]
+"""
+import argparse
+import json
+import time
+
+from cp_data_store import store
+from server import INPUT_DATA_FILE, parse_cache, submit_instance
+
+parser = argparse.ArgumentParser()
+parser.add_argument("input_data_path", nargs="?", default=str(store.base_dir / store.SERVICE_NAME / INPUT_DATA_FILE))
+
+
+def main(input_data_path):
+    if parse_cache is None or parse_cache.db_path is None:
+        raise ValueError("PARSER_CACHE_DB is not set, the warmed cache would be lost")
+    st_time = time.time()
+    requests_number, instances_number = 0, 0
+    with open(input_data_path, "r", encoding="utf8") as fin:
+        for line in fin:
+            if not line.strip():
+                continue
+            futures = [submit_instance(instance) for instance in json.loads(line)["input_data"]]
+            for future in futures:
+                if future is not None:
+                    future.result()
+                    instances_number += 1
+            requests_number += 1
+    print(
+        f"{instances_number} instances of {requests_number} requests are parsed in {time.time() - st_time:.3f}s, "
+        f"cache stats: {parse_cache.stats()}"
+    )
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args.input_data_path)
@@ -17,6 +17,7 @@ import logging
 import os
 import time
 
+from cp_batching.scheduler import BatchScheduler
 from cp_data_store import store
 from deeppavlov import build_model
 from flask import Flask, jsonify, request
@@ -36,9 +37,30 @@ app = Flask(__name__)
 health = HealthCheck(app, "/healthcheck")
 
 parser = build_model(DEEPPAVLOV_CONFIG)
+scheduler = BatchScheduler(
+    # the model returns the tokens and the labels of the batch, they are paired per sentence
+    lambda batch: list(zip(*parser.batched_call(batch, batch_size=len(batch)))),
+    max_wait=float(os.getenv("NER_BATCH_WAIT", 0.01)),
+    max_sentences=int(os.getenv("NER_MAX_PENDING_SENTENCES", 512)),
+    max_tokens=int(os.getenv("NER_MAX_BATCH_TOKENS", 4096)),
+    max_batch_size=int(os.getenv("NER_MAX_BATCH_SIZE", 64)),
+    log_interval=float(os.getenv("NER_LOG_INTERVAL", 60)),
+    name="ner-scheduler",
+)
 
 
-def handler(annotations):
+def submit_instance(annotations):
+    """
+    Enqueues all sentences of the instance to the batch scheduler,
+    so that sentences of all instances and concurrent requests are labeled together.
+    """
+    sents = annotations["annotations"]["basic_reader"]["clear_essay_sentences"]
+    data_to_parse = list(elem["words"] for elem in itertools.chain(*sents))
+    logger.debug(f"sentences: {str(data_to_parse)}")
+    return scheduler.submit(data_to_parse)
+
+
+def handler(annotations, future):
     """
     Calculates the annotation of the format
     [[labels_11, labels_12, ...], ...]
@@ -50,14 +72,11 @@ def handler(annotations):
     sents = annotations["annotations"]["basic_reader"]["clear_essay_sentences"]
     parsed_tokens = [[None] * len(elem) for elem in sents]
     parsed_labels = [[None] * len(elem) for elem in sents]
-    data_to_parse = list(elem["words"] for elem in itertools.chain(*sents))
-    logger.info(f"sentences: {str(data_to_parse)}")
-    tokens, labels = parser.batched_call(data_to_parse)
+    results = future.result()
     index = 0
     for i, paragraph in enumerate(sents):
         for j, _ in enumerate(paragraph):
-            parsed_tokens[i][j] = tokens[index]
-            parsed_labels[i][j] = labels[index]
+            parsed_tokens[i][j], parsed_labels[i][j] = results[index]
             index += 1
     return {"ner_labels": parsed_labels, "ner_tokens": parsed_tokens}
 
@@ -75,10 +94,10 @@ def respond():
     if STORE_DATA_ENABLE:
         store.save2json_line(request.json, INPUT_DATA_FILE)
     # `instance` is a single document
-    responses = [None] * len(request.json["input_data"])
-    logger.info(f"{SERVICE_NAME}: parsing {len(responses)} sentences.")
-    for i, elem in enumerate(request.json["input_data"]):
-        responses[i] = handler(elem)
+    input_data = request.json["input_data"]
+    logger.debug(f"{SERVICE_NAME}: parsing {len(input_data)} instances.")
+    futures = [submit_instance(elem) for elem in input_data]
+    responses = [handler(elem, future) for elem, future in zip(input_data, futures)]
     total_time = time.time() - st_time
     logger.info(f"{SERVICE_NAME} exec time: {total_time:.3f}s")
     return jsonify(responses)
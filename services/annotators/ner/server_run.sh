@@ -2,4 +2,4 @@ while ! pip install -r common_requirements.txt ; do sleep 5; done
 
 python -m deeppavlov download $DEEPPAVLOV_CONFIG
 
-gunicorn --workers=1 server:app -b 0.0.0.0:${SERVICE_PORT} --reload --timeout 120
\ No newline at end of file
+gunicorn --workers=1 --threads=${NER_THREADS:-4} server:app -b 0.0.0.0:${SERVICE_PORT} --reload --timeout 120
\ No newline at end of file
@@ -14,16 +14,15 @@
 
 import json
 import re
-from io import StringIO
 
 import nltk
 import numpy as np
 import pymorphy2
+from cp_conllu.tree import Tree
 from deeppavlov.core.commands.utils import expand_path
 from deeppavlov.core.common.registry import register
 from rapidfuzz import fuzz
 from sklearn.feature_extraction.text import TfidfVectorizer
-from udapi.block.read.conllu import Conllu
 
 
 @register("event_matcher")
@@ -121,10 +120,7 @@ class DateChecker:
             sentence = self.sanitize_punctuation(sentence)
             sentences.append(sentence)
 
-        if len(parses) > 0 and isinstance(parses[0], list):
-            parses = ["\n".join("\t".join(elem) for elem in parse) for parse in parses]
-        if len(parses) > 0 and isinstance(parses[0], str):
-            trees = [Conllu(filehandle=StringIO(parse)).read_tree() for parse in parses]
+        trees = [Tree.from_parse(parse) for parse in parses]
 
         for sentence, offset, tree, date_list in zip(sentences, offsets, trees, dates):
             for date in date_list:
@@ -17,6 +17,7 @@ import os
 import time
 from itertools import chain
 
+from cp_conllu.codec import decode_parse
 from cp_data_readers import prochtenie_reader
 from cp_data_store import store
 from flask import Flask, jsonify, request
@@ -47,7 +48,10 @@ def handler(instance):
     subject = instance["instance_info"]["subject"]
     if subject not in ["русский язык", "литература", "история", "обществознание"]:
         return {"mistakes": []}
-    parsed = list(chain.from_iterable(instance["annotations"]["morphosyntactic_parser"]["annotated_sentences"]))
+    parsed = [
+        decode_parse(parse)
+        for parse in chain.from_iterable(instance["annotations"]["morphosyntactic_parser"]["annotated_sentences"])
+    ]
     parsed.append([["END", "END", "END", "END", "END", "END", "END", "END", "END", "END"]])
     words, lemmas, pos = morph_parse(parsed)
     dupl_inds = find_dupl_inds(words, lemmas, pos)
@@ -0,0 +1,34 @@
+"""Word alignment of the original and the corrected sentences"""
+import difflib
+
+from cp_data_readers.utils import _word_tokenize
+
+
+def tokenize(text):
+    return _word_tokenize(text)[0]
+
+
+def get_opcodes(before, after):
+    """
+    Non-equal opcodes of ``difflib.SequenceMatcher`` for two word lists,
+    each opcode is ``[tag, (i1, i2), (j1, j2), before[i1:i2], after[j1:j2]]``.
+    """
+    if before == after:
+        return []
+    matcher = difflib.SequenceMatcher(None, before, after)
+    opcodes = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag != "equal":
+            opcodes.append([tag, (i1, i2), (j1, j2), before[i1:i2], after[j1:j2]])
+    return opcodes
+
+
+def align(before, after):
+    """
+    Tokenizes the sentences that are given as strings, returns the opcodes and the word lists.
+    """
+    if isinstance(before, str):
+        before = tokenize(before)
+    if isinstance(after, str):
+        after = tokenize(after)
+    return get_opcodes(before, after), before, after
@@ -0,0 +1,52 @@
+"""
+Replays the corrections from ``test_data`` through the error classifier without the gector model.
+The sentences are parsed by spaCy once, so only the opcode mapping and ``classify_changes`` are timed.
+To use:
+    python benchmark_classify.py -n 100
+"""
+import argparse
+import json
+import os
+import time
+
+from cp_tests import utils
+from label_errors import parse_sentences
+from server import get_texts_to_parse, handler
+
+TEST_DATA_DIR = os.getenv("TEST_DATA_DIR", "test_data")
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-n", "--repeats", type=int, default=100)
+
+
+def read_instances(data_dir):
+    instances = []
+    for request_file, response_file in utils.get_data(data_dir):
+        request = json.load(request_file.open())
+        response = json.load(response_file.open())
+        instance = request["input_data"][0]
+        corrected = [sent["text"] for paragraph in response["essay_sentences"] for sent in paragraph]
+        instances.append((instance, corrected, response["selections"]))
+    return instances
+
+
+def main(repeats):
+    instances = read_instances(TEST_DATA_DIR)
+    texts = [text for instance, corrected, _ in instances for text in get_texts_to_parse(instance, corrected)]
+    parsed = parse_sentences(texts)
+    for instance, corrected, selections in instances:
+        is_equal_flag, msg = utils.compare_structs(selections, handler(instance, corrected, parsed)["selections"])
+        assert is_equal_flag, msg
+    print(f"{len(instances)} essays, outputs are identical")
+
+    st_time = time.time()
+    for _ in range(repeats):
+        for instance, corrected, _ in instances:
+            handler(instance, corrected, parsed)
+    total_time = (time.time() - st_time) / repeats
+    print(f"classification: {total_time * 1000:.2f}ms per pass")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args.repeats)
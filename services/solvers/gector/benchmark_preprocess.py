@@ -0,0 +1,76 @@
+"""
+Compares the direct tensor builder of ``GecBERTModel.preprocess``
+with the AllenNLP Instance/Batch path on the sentences from ``test_data``.
+To use:
+    python benchmark_preprocess.py -b 64 -n 10
+"""
+import argparse
+import itertools
+import json
+import os
+import time
+
+import torch
+from cp_tests import utils
+from gector.gec_model import GecBERTModel
+
+TEST_DATA_DIR = os.getenv("TEST_DATA_DIR", "test_data")
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-b", "--batch_size", type=int, default=64)
+parser.add_argument("-n", "--repeats", type=int, default=10)
+
+
+def read_sentences(data_dir):
+    sentences = []
+    for request_file, _ in utils.get_data(data_dir):
+        request = json.load(request_file.open())
+        for instance in request["input_data"]:
+            if "contraction_corrector" not in instance["annotations"]:
+                continue
+            paragraphs = instance["annotations"]["contraction_corrector"]["essay_sentences"]
+            sentences.extend(sent["words"] for sent in itertools.chain.from_iterable(paragraphs))
+    return sentences
+
+
+def to_tensor_dicts(batches):
+    return [batch.as_tensor_dict() if not isinstance(batch, dict) else batch for batch in batches]
+
+
+def main(batch_size, repeats):
+    model = GecBERTModel(
+        vocab_path="vocab/output_vocabulary",
+        model_paths=["/model_data/xlnet_0_gector.th", "/model_data/roberta_1_gector.th"],
+        min_probability=0.0,
+        model_name="roberta",
+        special_tokens_fix=0,
+        is_ensemble=True,
+    )
+    sentences = read_sentences(TEST_DATA_DIR)
+    batches = [sentences[i : i + batch_size] for i in range(0, len(sentences), batch_size)]
+    print(f"{len(sentences)} sentences, {len(batches)} batches")
+
+    for batch in batches:
+        model.fast_preprocess = False
+        expected = to_tensor_dicts(model.preprocess(batch))
+        model.fast_preprocess = True
+        actual = to_tensor_dicts(model.preprocess(batch))
+        for expected_dict, actual_dict in zip(expected, actual):
+            for key, value in expected_dict["tokens"].items():
+                assert torch.equal(value, actual_dict["tokens"][key]), f"mismatch in `{key}`"
+    print("Outputs are identical")
+
+    for fast_preprocess in [False, True]:
+        model.fast_preprocess = fast_preprocess
+        st_time = time.time()
+        for _ in range(repeats):
+            for batch in batches:
+                to_tensor_dicts(model.preprocess(batch))
+        total_time = (time.time() - st_time) / repeats
+        name = "tensor builder" if fast_preprocess else "allennlp instances"
+        print(f"{name}: {total_time:.3f}s per pass")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args.batch_size, args.repeats)
@@ -0,0 +1,25 @@
+"""
+Builds the memory-mapped index of the SCOWL dictionary used by ``label_errors``.
+To use:
+    python build_dictionary.py /data/dictionaries/scowl_70 /root/.cache/gector/scowl_70.idx
+"""
+import argparse
+
+from gector.word_index import WordIndex, build_word_index, read_words
+
+parser = argparse.ArgumentParser()
+parser.add_argument("dictionary_dir")
+parser.add_argument("index_path")
+
+
+def main(dictionary_dir, index_path):
+    words = read_words(dictionary_dir)
+    build_word_index(words, index_path)
+    index = WordIndex(index_path)
+    assert len(index) == len(words) and all(word in index for word in words)
+    print(f"{len(index)} words are saved to {index_path}")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args.dictionary_dir, args.index_path)
@@ -1,9 +1,13 @@
 """Wrapper of AllenNLP model. Fixes errors based on model predictions"""
+import hashlib
+import json
 import logging
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from time import time
 
+import numpy
 import torch
 from allennlp.data.dataset import Batch
 from allennlp.data.fields import TextField
@@ -13,14 +17,31 @@ from allennlp.data.vocabulary import Vocabulary
 from allennlp.modules.text_field_embedders import BasicTextFieldEmbedder
 from allennlp.nn import util
 from gector.bert_token_embedder import PretrainedBertEmbedder
+from gector.inference_backend import (
+    VALIDATION_SENTENCES,
+    build_backend,
+    compare_outputs,
+    make_validation_batches,
+    read_validation_sentences,
+    save_report,
+)
 from gector.seq2labels_model import Seq2Labels
 from gector.wordpiece_indexer import PretrainedBertIndexer
-from utils.helpers import PAD, START_TOKEN, UNK, get_target_sent_by_edits
+from utils.helpers import PAD, START_TOKEN, UNK, get_target_sent_by_edits, read_lines
 
 logging.getLogger("werkzeug").setLevel(logging.ERROR)
 logger = logging.getLogger(__file__)
 
 
+def get_file_hash(path, chunk_size=1 << 20):
+    """sha256 of the file contents, read in chunks"""
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as fin:
+        for chunk in iter(lambda: fin.read(chunk_size), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
 def get_weights_name(transformer_name, lowercase):
     if transformer_name == "bert" and lowercase:
         return "bert-base-uncased"
@@ -64,6 +85,17 @@ class GecBERTModel(object):
         min_error_probability=0.0,
         confidence=0,
         resolve_cycles=False,
+        batch_size=64,
+        max_batch_pieces=None,
+        sort_by_length=False,
+        fast_preprocess=True,
+        parallel_models=True,
+        bpe_cache_size=100000,
+        bpe_warmup_file=None,
+        backend="eager",
+        backend_cache_dir=None,
+        backend_validation_dir=None,
+        min_backend_agreement=0.99,
     ):
         self.model_weights = list(map(float, weigths)) if weigths else [1] * len(model_paths)
         self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
@@ -77,6 +109,16 @@ class GecBERTModel(object):
         self.iterations = iterations
         self.confidence = confidence
         self.resolve_cycles = resolve_cycles
+        # batching parameters: at most `batch_size` sentences and, if set,
+        # at most `max_batch_pieces` padded wordpieces in a single forward pass
+        self.batch_size = batch_size
+        self.max_batch_pieces = max_batch_pieces
+        self.sort_by_length = sort_by_length
+        # build padded tensors directly instead of AllenNLP Instance/Batch objects
+        self.fast_preprocess = fast_preprocess
+        self.bpe_cache_size = bpe_cache_size
+        # statistics of the iterations of the last ``handle_batch`` call
+        self.iteration_stats = []
         # set training parameters and operations
 
         self.indexers = []
@@ -97,6 +139,104 @@ class GecBERTModel(object):
                 model.load_state_dict(torch.load(model_path, map_location=torch.device("cpu")))
             model.eval()
             self.models.append(model)
+        # the weights are hashed once at load time, the hashes are a part of the result cache key
+        self.weights_hashes = [get_file_hash(model_path) for model_path in model_paths]
+        if bpe_warmup_file:
+            self.warm_up(bpe_warmup_file)
+        # members with identical tokenization share a single encoding of the batch
+        fingerprints = [indexer["bert"].fingerprint for indexer in self.indexers]
+        self._shared_indexers = [fingerprints.index(fingerprint) for fingerprint in fingerprints]
+        self._executor = self._get_executor() if parallel_models else None
+        # quantized and traced backends are used only for CPU inference
+        self.backend = backend if self.device.type == "cpu" else "eager"
+        self.backend_reports = []
+        if self.backend != "eager":
+            self._init_backend(model_paths, backend_cache_dir, backend_validation_dir, min_backend_agreement)
+        self.fingerprint = self._get_fingerprint()
+
+    def _get_executor(self):
+        """
+        Ensemble members are run concurrently on CPU, so the latency is the maximum instead of the sum.
+        The intra-op threads are divided between the members instead of every member using all cores,
+        the members are run one by one if there are fewer cores than members or if they share a GPU.
+        """
+        if len(self.models) < 2 or self.device.type != "cpu":
+            return None
+        threads = torch.get_num_threads() // len(self.models)
+        if threads < 1:
+            return None
+        return ThreadPoolExecutor(max_workers=len(self.models), initializer=torch.set_num_threads, initargs=(threads,))
+
+    def _get_fingerprint(self):
+        """
+        Hash of the contents of the model weights and of the parameters that change the output of ``handle_batch``.
+        """
+        config = [
+            self.weights_hashes,
+            self.model_weights,
+            self.backend,
+            self.max_len,
+            self.min_len,
+            self.lowercase_tokens,
+            self.iterations,
+            self.min_probability,
+            self.min_error_probability,
+            self.confidence,
+        ]
+        return hashlib.md5(json.dumps(config).encode("utf8")).hexdigest()
+
+    def _preprocess_tensors(self, token_batch):
+        """
+        ``preprocess`` with the AllenNLP batches of ``fast_preprocess=False`` converted to tensor dicts on the device.
+        """
+        return [
+            util.move_to_device(
+                batch if isinstance(batch, dict) else batch.as_tensor_dict(), 0 if torch.cuda.is_available() else -1
+            )
+            for batch in self.preprocess(token_batch)
+        ]
+
+    def _init_backend(self, model_paths, cache_dir, validation_dir, min_agreement):
+        """
+        Replaces the models with their quantized or traced versions.
+        The backends are validated on the sentences of ``validation_dir`` (the service test data) in batches
+        of different sizes and lengths, a model is kept in fp32 eager mode if the trace check fails
+        or if the agreement of the labels with it is lower than ``min_agreement``.
+        """
+        sentences = read_validation_sentences(validation_dir) if validation_dir else VALIDATION_SENTENCES
+        # a model batch per member for every validation batch
+        validation_batches = [self._preprocess_tensors(batch) for batch in make_validation_batches(sentences)]
+        example_batches = self._preprocess_tensors(VALIDATION_SENTENCES[:2])
+        check_batches = [
+            self._preprocess_tensors(batch) for batch in make_validation_batches(VALIDATION_SENTENCES, [1, 3])
+        ]
+        for i, model_path in enumerate(model_paths):
+            model = self.models[i]
+            try:
+                backend_model = build_backend(
+                    model,
+                    model_path,
+                    self.backend,
+                    example_batches[i],
+                    cache_dir,
+                    weights_hash=self.weights_hashes[i],
+                    check_batches=[batches[i] for batches in check_batches],
+                )
+            except (torch.jit.TracingCheckError, RuntimeError) as e:
+                logger.exception(f"{self.backend} backend of {model_path} failed, eager mode is used")
+                report = {"error": f"{type(e).__name__}: {e}", "model": model_path, "backend": self.backend}
+                self.backend_reports.append(dict(report, used=False))
+                continue
+            report = compare_outputs(model, backend_model, [batches[i] for batches in validation_batches])
+            report.update(model=model_path, backend=self.backend, used=report["label_agreement"] >= min_agreement)
+            self.backend_reports.append(report)
+            logger.info(f"Agreement report: {report}")
+            if report["used"]:
+                self.models[i] = backend_model
+            else:
+                logger.warning(f"{self.backend} backend disagrees with fp32 model {model_path}, eager mode is used")
+        if cache_dir:
+            save_report(self.backend_reports, cache_dir)
 
     @staticmethod
     def _get_model_data(model_path):
@@ -131,14 +271,21 @@ class GecBERTModel(object):
                     continue
         print("Model is restored", file=sys.stderr)
 
+    @staticmethod
+    def _forward(model, batch):
+        if isinstance(batch, Batch):
+            batch = batch.as_tensor_dict()
+        batch = util.move_to_device(batch, 0 if torch.cuda.is_available() else -1)
+        # `no_grad` is thread local, so it is set inside of the worker thread
+        with torch.no_grad():
+            return model.forward(**batch)
+
     def predict(self, batches):
         t11 = time()
-        predictions = []
-        for batch, model in zip(batches, self.models):
-            batch = util.move_to_device(batch.as_tensor_dict(), 0 if torch.cuda.is_available() else -1)
-            with torch.no_grad():
-                prediction = model.forward(**batch)
-            predictions.append(prediction)
+        if self._executor is not None:
+            predictions = list(self._executor.map(self._forward, self.models, batches))
+        else:
+            predictions = [self._forward(model, batch) for batch, model in zip(batches, self.models)]
 
         preds, idx, error_probs = self._convert(predictions)
         t55 = time()
@@ -193,14 +340,60 @@ class GecBERTModel(object):
             truncate_long_sequences=True,
             special_tokens_fix=special_tokens_fix,
             is_test=True,
+            bpe_cache_size=self.bpe_cache_size,
         )
         return {"bert": bert_token_indexer}
 
+    def warm_up(self, frequency_file):
+        """
+        Fills tokenization caches with the words of a frequency list.
+        Each line of the file starts with a word, the most frequent words come first.
+        """
+        words = [line.split()[0] for line in read_lines(frequency_file)]
+        if self.bpe_cache_size is not None:
+            words = words[: self.bpe_cache_size]
+        for indexer in self.indexers:
+            indexer["bert"].warm_up(words)
+
+    def get_cache_stats(self):
+        return [indexer["bert"].cache.stats() for indexer in self.indexers]
+
     def preprocess(self, token_batch):
         seq_lens = [len(sequence) for sequence in token_batch if sequence]
         if not seq_lens:
             return []
         max_len = min(max(seq_lens), self.max_len)
+        if not self.fast_preprocess:
+            return self.preprocess_instances(token_batch, max_len)
+        batches = []
+        for i, indexer in enumerate(self.indexers):
+            if self._shared_indexers[i] != i:
+                batches.append(batches[self._shared_indexers[i]])
+                continue
+            indexed = [
+                indexer["bert"].texts_to_indices([START_TOKEN] + sequence[:max_len], "bert") for sequence in token_batch
+            ]
+            batches.append({"tokens": self._pad_indices(indexed)})
+        return batches
+
+    @staticmethod
+    def _pad_indices(indexed):
+        """
+        Pads every key of the indexed sentences with zeros up to its maximal length in the batch,
+        the result is the same as the output of ``Batch.as_tensor_dict``.
+        """
+        tensors = {}
+        for key in indexed[0]:
+            array = numpy.zeros((len(indexed), max(len(elem[key]) for elem in indexed)), dtype=numpy.int64)
+            for i, elem in enumerate(indexed):
+                array[i, : len(elem[key])] = elem[key]
+            tensors[key] = torch.from_numpy(array)
+        return tensors
+
+    def preprocess_instances(self, token_batch, max_len):
+        """
+        Builds AllenNLP batches for the models, is slower than the tensor builder of ``preprocess``.
+        """
         batches = []
         for indexer in self.indexers:
             batch = []
@@ -214,17 +407,68 @@ class GecBERTModel(object):
 
         return batches
 
+    def _count_pieces(self, tokens):
+        """
+        The number of wordpieces of the sentence for the member, which splits it into the most pieces,
+        so that the forward pass of every member fits into ``max_batch_pieces``.
+        """
+        tokens = [START_TOKEN] + tokens[: self.max_len]
+        return max(self.indexers[i]["bert"].count_pieces(tokens) for i in set(self._shared_indexers))
+
+    def _make_buckets(self, token_batch):
+        """
+        Splits sentences into batches, returns lists of indices into ``token_batch``.
+        In ``sort_by_length`` mode the sentences are sorted by wordpiece length,
+        so that every batch contains sentences of close length and padding is minimal.
+        """
+        if not self.sort_by_length:
+            return [
+                list(range(start, min(start + self.batch_size, len(token_batch))))
+                for start in range(0, len(token_batch), self.batch_size)
+            ]
+        lengths = [self._count_pieces(tokens) for tokens in token_batch]
+        buckets, bucket = [], []
+        for i in sorted(range(len(token_batch)), key=lambda i: lengths[i]):
+            # sentences are sorted, so the current one is the longest in the bucket
+            padded_pieces = (len(bucket) + 1) * lengths[i]
+            if bucket and (
+                len(bucket) == self.batch_size or (self.max_batch_pieces and padded_pieces > self.max_batch_pieces)
+            ):
+                buckets.append(bucket)
+                bucket = []
+            bucket.append(i)
+        if bucket:
+            buckets.append(bucket)
+        return buckets
+
+    def predict_batch(self, token_batch):
+        """
+        Predicts corrected sentences for a batch of any size, the output keeps the order of ``token_batch``.
+        """
+        pred_batch = token_batch[:]
+        for bucket in self._make_buckets(token_batch):
+            bucket_batch = [token_batch[i] for i in bucket]
+            sequences = self.preprocess(bucket_batch)
+            if not sequences:
+                continue
+            probabilities, idxs, error_probs = self.predict(sequences)
+            bucket_preds = self.postprocess_batch(bucket_batch, probabilities, idxs, error_probs)
+            for i, pred in zip(bucket, bucket_preds):
+                pred_batch[i] = pred
+        return pred_batch
+
     def _convert(self, data):
-        all_class_probs = torch.zeros_like(data[0]["class_probabilities_labels"])
-        error_probs = torch.zeros_like(data[0]["max_error_probability"])
-        for output, weight in zip(data, self.model_weights):
-            all_class_probs += weight * output["class_probabilities_labels"] / sum(self.model_weights)
-            error_probs += weight * output["max_error_probability"] / sum(self.model_weights)
+        # weighted average of the ensemble members as a single reduction over the stacked outputs
+        weights = data[0]["class_probabilities_labels"].new_tensor(self.model_weights) / sum(self.model_weights)
+        all_class_probs = torch.tensordot(
+            weights, torch.stack([output["class_probabilities_labels"] for output in data]), dims=1
+        )
+        error_probs = torch.tensordot(
+            weights, torch.stack([output["max_error_probability"] for output in data]), dims=1
+        )
 
-        max_vals = torch.max(all_class_probs, dim=-1)
-        probs = max_vals[0].tolist()
-        idx = max_vals[1].tolist()
-        return probs, idx, error_probs.tolist()
+        probs, idx = torch.max(all_class_probs, dim=-1)
+        return probs, idx, error_probs
 
     def update_final_batch(self, final_batch, pred_ids, pred_batch, prev_preds_dict):
         new_pred_ids = []
@@ -247,69 +491,109 @@ class GecBERTModel(object):
         return final_batch, new_pred_ids, total_updated
 
     def postprocess_batch(self, batch, all_probabilities, all_idxs, error_probs, max_len=50):
-        all_results = []
+        """
+        Applies predicted edits to the sentences of the batch.
+        ``all_probabilities`` and ``all_idxs`` are tensors of shape (batch_size, sequence_length),
+        only the positions with edits are moved from the tensors to Python.
+        """
         noop_index = self.vocab.get_token_index("$KEEP", "labels")
-        for tokens, probabilities, idxs, error_prob in zip(batch, all_probabilities, all_idxs, error_probs):
-            length = min(len(tokens), max_len)
-            edits = []
-
-            # skip whole sentences if there no errors
-            if max(idxs) == 0:
-                all_results.append(tokens)
-                continue
-
-            # skip whole sentence if probability of correctness is not high
-            if error_prob < self.min_error_probability:
-                all_results.append(tokens)
-                continue
-
-            for i in range(length + 1):
-                # because of START token
-                if i == 0:
-                    token = START_TOKEN
-                else:
-                    token = tokens[i - 1]
-                # skip if there is no error
-                if idxs[i] == noop_index:
-                    continue
-
-                sugg_token = self.vocab.get_token_from_index(idxs[i], namespace="labels")
-                action = self.get_token_action(token, i, probabilities[i], sugg_token)
-                if not action:
-                    continue
+        # skip whole sentences if there no errors or if probability of correctness is not high
+        to_correct = [
+            max_idx != 0 and error_prob >= self.min_error_probability
+            for max_idx, error_prob in zip(all_idxs.max(dim=-1)[0].tolist(), error_probs.tolist())
+        ]
+        if not any(to_correct):
+            return batch[:]
+
+        # position 0 corresponds to START token, so positions up to the sentence length are considered
+        lengths = all_idxs.new_tensor([min(len(tokens), max_len) for tokens in batch])
+        positions = torch.arange(all_idxs.size(1), device=all_idxs.device)
+        edits_mask = (
+            all_idxs.new_tensor(to_correct, dtype=torch.bool).unsqueeze(1)
+            & (positions.unsqueeze(0) <= lengths.unsqueeze(1))
+            & (all_idxs != noop_index)
+            & (all_probabilities >= self.min_probability)
+        )
+        rows, positions = edits_mask.nonzero(as_tuple=True)
+
+        all_edits = [[] for _ in batch]
+        edit_idxs = all_idxs[rows, positions].tolist()
+        edit_probs = all_probabilities[rows, positions].tolist()
+        for row, i, idx, prob in zip(rows.tolist(), positions.tolist(), edit_idxs, edit_probs):
+            token = START_TOKEN if i == 0 else batch[row][i - 1]
+            sugg_token = self.vocab.get_token_from_index(idx, namespace="labels")
+            action = self.get_token_action(token, i, prob, sugg_token)
+            if action:
+                all_edits[row].append(action)
+        return [
+            get_target_sent_by_edits(tokens, edits) if flag else tokens
+            for tokens, edits, flag in zip(batch, all_edits, to_correct)
+        ]
+
+    def _set_token_cache(self, enabled):
+        for indexer in self.indexers:
+            indexer["bert"].token_ids_cache = {} if enabled else None
+            indexer["bert"].token_cache_hits = 0
+            indexer["bert"].token_cache_misses = 0
 
-                edits.append(action)
-            all_results.append(get_target_sent_by_edits(tokens, edits))
-        return all_results
+    def _get_token_cache_stats(self):
+        hits = sum(indexer["bert"].token_cache_hits for indexer in self.indexers)
+        misses = sum(indexer["bert"].token_cache_misses for indexer in self.indexers)
+        return hits, misses
 
     def handle_batch(self, full_batch):
         """
         Handle batch of requests.
+
+        Only the sentences changed by the previous iteration are predicted again,
+        a sentence leaves the loop as soon as its correction is a fixed point or repeats a previous one.
+        Wordpiece ids of the tokens are kept between iterations, so only the edited tokens are tokenized again.
         """
         final_batch = full_batch[:]
         batch_size = len(full_batch)
         prev_preds_dict = {i: [final_batch[i]] for i in range(len(final_batch))}
-        short_ids = [i for i in range(len(full_batch)) if len(full_batch[i]) < self.min_len]
-        pred_ids = [i for i in range(len(full_batch)) if i not in short_ids]
+        pred_ids = [i for i in range(len(full_batch)) if len(full_batch[i]) >= self.min_len]
         total_updates = 0
-
-        for n_iter in range(self.iterations):
-            orig_batch = [final_batch[i] for i in pred_ids]
-
-            sequences = self.preprocess(orig_batch)
-
-            if not sequences:
-                break
-            probabilities, idxs, error_probs = self.predict(sequences)
-
-            pred_batch = self.postprocess_batch(orig_batch, probabilities, idxs, error_probs)
-            if self.log:
-                print(f"Iteration {n_iter + 1}. Predicted {round(100*len(pred_ids)/batch_size, 1)}% of sentences.")
-
-            final_batch, pred_ids, cnt = self.update_final_batch(final_batch, pred_ids, pred_batch, prev_preds_dict)
-            total_updates += cnt
-
-            if not pred_ids:
-                break
+        self.iteration_stats = []
+
+        self._set_token_cache(True)
+        try:
+            for n_iter in range(self.iterations):
+                orig_batch = [final_batch[i] for i in pred_ids]
+                if not orig_batch:
+                    break
+
+                t11 = time()
+                prev_hits, prev_misses = self._get_token_cache_stats()
+                pred_batch = self.predict_batch(orig_batch)
+                if self.log:
+                    print(f"Iteration {n_iter + 1}. Predicted {round(100*len(pred_ids)/batch_size, 1)}% of sentences.")
+
+                final_batch, new_pred_ids, cnt = self.update_final_batch(
+                    final_batch, pred_ids, pred_batch, prev_preds_dict
+                )
+                total_updates += cnt
+
+                hits, misses = self._get_token_cache_stats()
+                self.iteration_stats.append(
+                    {
+                        "iteration": n_iter + 1,
+                        "predicted": len(pred_ids),
+                        "updated": cnt,
+                        "remaining": len(new_pred_ids),
+                        "reused_tokens": hits - prev_hits,
+                        "tokenized_tokens": misses - prev_misses,
+                        "time": time() - t11,
+                    }
+                )
+                pred_ids = new_pred_ids
+
+                if not pred_ids:
+                    break
+        finally:
+            self._set_token_cache(False)
+        if self.log:
+            for stats in self.iteration_stats:
+                print(stats)
 
         return final_batch, total_updates
@@ -0,0 +1,186 @@
+"""Optimized CPU inference backends for Seq2Labels models"""
+import glob
+import hashlib
+import json
+import logging
+import os
+import random
+
+import torch
+
+logger = logging.getLogger(__file__)
+
+# eager: fp32 eager mode
+# quantized: dynamic int8 quantization of Linear layers
+# traced: TorchScript graph of Seq2Labels and its embedder
+# quantized_traced: TorchScript graph of the quantized model
+BACKENDS = ["eager", "quantized", "traced", "quantized_traced"]
+
+# sentences of different length, which are used to trace the models and to validate them
+VALIDATION_SENTENCES = [
+    ["This", "is", "an", "example", "sentence", "."],
+    ["Nowadays", "a", "lot", "of", "people", "thinks", "that", "sport", "unite", "peoples", "."],
+    ["I", "am", "agree", "with", "this", "opinion", "because", "it", "help", "us", "to", "be", "healthy", "."],
+    ["In", "my", "opinion", ",", "the", "young", "people", "should", "spent", "more", "time", "outside", "."],
+    ["Firstly", ",", "sport", "make", "people", "more", "strong", "and", "they", "are", "feeling", "better", "."],
+    ["To", "sum", "up", ",", "I", "would", "like", "to", "say", "that", "every", "coins", "has", "two", "sides", "."],
+    ["Besides", ",", "many", "of", "my", "friends", "goes", "to", "the", "gym", "after", "the", "school", "and", "they"]
+    + ["enjoy", "it", "very", "much", "because", "they", "can", "meet", "a", "new", "peoples", "there", "."],
+    ["Thanks", "!"],
+]
+# the validation sentences are split into batches of these sizes in turn
+VALIDATION_BATCH_SIZES = [1, 4, 16, 64]
+
+
+class ExportedSeq2Labels(object):
+    """
+    Wraps a TorchScript graph with the interface of ``Seq2Labels.forward``,
+    only the outputs used at inference are returned.
+    """
+
+    def __init__(self, module):
+        self.module = module
+
+    def forward(self, tokens):
+        class_probabilities_labels, max_error_probability = self.module(
+            tokens["bert"], tokens["bert-offsets"], tokens["mask"]
+        )
+        return {
+            "class_probabilities_labels": class_probabilities_labels,
+            "max_error_probability": max_error_probability,
+        }
+
+    __call__ = forward
+
+
+class _Seq2LabelsOutputs(torch.nn.Module):
+    """
+    Takes tensors instead of a dict and returns a tuple of tensors, so that the model can be traced.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, offsets, mask):
+        output = self.model(tokens={"bert": input_ids, "bert-offsets": offsets, "mask": mask})
+        return output["class_probabilities_labels"], output["max_error_probability"]
+
+
+def read_validation_sentences(test_data_dir, limit=256):
+    """
+    Word lists of the sentences of the service test data sampled evenly over their lengths,
+    ``VALIDATION_SENTENCES`` if there is no test data.
+    """
+    sentences = []
+    for path in sorted(glob.glob(os.path.join(test_data_dir, "*_input.json"))):
+        with open(path, encoding="utf8") as fin:
+            data = json.load(fin)
+        for instance in data.get("input_data", []):
+            paragraphs = instance.get("annotations", {}).get("contraction_corrector", {}).get("essay_sentences", [])
+            sentences.extend(sent["words"] for paragraph in paragraphs for sent in paragraph if sent["words"])
+    sentences.sort(key=len)
+    if len(sentences) > limit:
+        step = len(sentences) / limit
+        sentences = [sentences[int(i * step)] for i in range(limit)]
+    return sentences or VALIDATION_SENTENCES
+
+
+def make_validation_batches(sentences, batch_sizes=VALIDATION_BATCH_SIZES, seed=0):
+    """
+    Splits the sentences into batches of ``batch_sizes`` in turn,
+    the sentences are shuffled, so that the batches have different lengths and padding.
+    """
+    sentences = list(sentences)
+    random.Random(seed).shuffle(sentences)
+    batches, start, i = [], 0, 0
+    while start < len(sentences):
+        batch_size = batch_sizes[i % len(batch_sizes)]
+        batches.append(sentences[start : start + batch_size])
+        start += batch_size
+        i += 1
+    return batches
+
+
+def get_cache_path(model_path, weights_hash, backend, cache_dir):
+    """
+    The name of the cached graph depends on the hash of the model weights, the backend and the torch version.
+    """
+    key = f"{weights_hash}|{backend}|{torch.__version__}"
+    fingerprint = hashlib.md5(key.encode("utf8")).hexdigest()[:12]
+    return os.path.join(cache_dir, f"{os.path.basename(model_path)}.{backend}.{fingerprint}.pt")
+
+
+def build_backend(model, model_path, backend, example_batch, cache_dir=None, weights_hash=None, check_batches=()):
+    """
+    Returns an object with the interface of ``model.forward`` that runs the model with the chosen backend.
+    The traced graph is checked against ``check_batches`` of other shapes, ``torch.jit.TracingCheckError``
+    is raised if it depends on the data of the example batch.
+    Traced graphs are saved to ``cache_dir`` and loaded from it on the next start.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend {backend}, expected one of {BACKENDS}")
+    if backend == "eager":
+        return model
+    traced = backend.endswith("traced")
+    cache_path = None
+    if cache_dir and traced and weights_hash:
+        cache_path = get_cache_path(model_path, weights_hash, backend, cache_dir)
+    if cache_path and os.path.exists(cache_path):
+        logger.info(f"Loading {backend} model from {cache_path}")
+        return ExportedSeq2Labels(torch.jit.load(cache_path))
+
+    if backend.startswith("quantized"):
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    if not traced:
+        return model
+
+    def get_inputs(batch):
+        tokens = batch["tokens"]
+        return tokens["bert"], tokens["bert-offsets"], tokens["mask"]
+
+    with torch.no_grad():
+        module = torch.jit.trace(
+            _Seq2LabelsOutputs(model).eval(),
+            get_inputs(example_batch),
+            check_trace=True,
+            check_inputs=[get_inputs(batch) for batch in check_batches] or None,
+        )
+    if cache_path:
+        os.makedirs(cache_dir, exist_ok=True)
+        torch.jit.save(module, cache_path)
+        logger.info(f"Saved {backend} model to {cache_path}")
+    return ExportedSeq2Labels(module)
+
+
+def compare_outputs(reference, candidate, batches):
+    """
+    Agreement report of the candidate backend with the fp32 eager model.
+    """
+    agreed, total = 0, 0
+    max_probability_diff, max_error_probability_diff = 0.0, 0.0
+    for batch in batches:
+        with torch.no_grad():
+            expected = reference.forward(**batch)
+            actual = candidate.forward(**batch)
+        mask = batch["tokens"]["mask"].bool()
+        expected_labels = expected["class_probabilities_labels"].argmax(dim=-1)[mask]
+        actual_labels = actual["class_probabilities_labels"].argmax(dim=-1)[mask]
+        agreed += (expected_labels == actual_labels).sum().item()
+        total += mask.sum().item()
+        probability_diff = expected["class_probabilities_labels"] - actual["class_probabilities_labels"]
+        max_probability_diff = max(max_probability_diff, probability_diff.abs().max().item())
+        error_probability_diff = expected["max_error_probability"] - actual["max_error_probability"]
+        max_error_probability_diff = max(max_error_probability_diff, error_probability_diff.abs().max().item())
+    return {
+        "label_agreement": agreed / total if total else 1.0,
+        "max_probability_diff": max_probability_diff,
+        "max_error_probability_diff": max_error_probability_diff,
+        "tokens": total,
+    }
+
+
+def save_report(reports, cache_dir):
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, "agreement_report.json"), "w") as fout:
+        json.dump(reports, fout, indent=4)
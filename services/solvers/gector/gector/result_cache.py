@@ -0,0 +1,71 @@
+"""Content-addressed cache of corrected sentences"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+from gector.lru_cache import LRUCache
+
+
+class CorrectionCache(object):
+    """
+    Two-tier cache of the model outputs: an in-process LRU and an optional SQLite database on disk.
+    A key depends on the words of the sentence and on the fingerprint of the model and its parameters,
+    so the cache stays valid across restarts and is not reused after the model is changed.
+    """
+
+    def __init__(self, fingerprint, maxsize=100000, db_path=None):
+        self.fingerprint = fingerprint
+        self.memory = LRUCache(maxsize)
+        self.db_path = db_path
+        self.disk_hits = 0
+        self._lock = threading.Lock()
+        self._connection = None
+        if db_path:
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+            self._connection = sqlite3.connect(db_path, check_same_thread=False)
+            self._connection.execute("CREATE TABLE IF NOT EXISTS corrections (key TEXT PRIMARY KEY, value TEXT)")
+            self._connection.commit()
+
+    def make_key(self, words):
+        data = json.dumps([self.fingerprint, list(words)], ensure_ascii=False)
+        return hashlib.sha1(data.encode("utf8")).hexdigest()
+
+    def get_many(self, sentences):
+        """
+        Returns cached corrections of the sentences, ``None`` for the sentences that are not cached.
+        """
+        keys = [self.make_key(words) for words in sentences]
+        corrections = [self.memory.get(key) for key in keys]
+        missing = [i for i, correction in enumerate(corrections) if correction is None]
+        if missing and self._connection is not None:
+            with self._lock:
+                for i in missing:
+                    row = self._connection.execute("SELECT value FROM corrections WHERE key = ?", (keys[i],)).fetchone()
+                    if row is not None:
+                        corrections[i] = json.loads(row[0])
+                        self.memory.put(keys[i], corrections[i])
+                        self.disk_hits += 1
+        return corrections
+
+    def put_many(self, sentences, corrections):
+        rows = []
+        for words, correction in zip(sentences, corrections):
+            key = self.make_key(words)
+            self.memory.put(key, correction)
+            rows.append((key, json.dumps(correction, ensure_ascii=False)))
+        if self._connection is not None:
+            with self._lock:
+                self._connection.executemany("INSERT OR REPLACE INTO corrections VALUES (?, ?)", rows)
+                self._connection.commit()
+
+    def stats(self):
+        memory_stats = self.memory.stats()
+        requests = memory_stats["hits"] + memory_stats["misses"]
+        hits = memory_stats["hits"] + self.disk_hits
+        return {
+            "memory": memory_stats,
+            "disk_hits": self.disk_hits,
+            "hit_rate": hits / requests if requests else 0.0,
+        }
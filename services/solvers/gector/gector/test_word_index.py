@@ -0,0 +1,52 @@
+import os
+import random
+import tempfile
+
+from gector.word_index import WordIndex, build_word_index, read_words
+
+
+def test_word_index():
+    rng = random.Random(0)
+    alphabet = "abcxyzäöéёжя'-"
+    words = {"".join(rng.choice(alphabet) for _ in range(rng.randint(1, 8))) for _ in range(3000)}
+    queries = ["".join(rng.choice(alphabet) for _ in range(rng.randint(0, 8))) for _ in range(3000)]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "index", "words.idx")
+        build_word_index(words, path)
+        index = WordIndex(path)
+        assert len(index) == len(words)
+        # the words are sorted bytewise for the binary search
+        assert list(index) == sorted(word.encode("utf8") for word in words)
+        for word in list(words) + queries:
+            assert (word in index) == (word in words), word
+        assert None not in index and b"abc" not in index
+
+
+def test_empty_and_invalid_index():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "empty.idx")
+        build_word_index([], path)
+        index = WordIndex(path)
+        assert len(index) == 0 and "a" not in index
+        with open(path, "wb") as fout:
+            fout.write(b"NOTINDEX" + bytes(8))
+        try:
+            WordIndex(path)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("a file without the magic is opened")
+
+
+def test_read_words():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, text in [("english-words.10", "cat\ndog\n"), ("english-words.20", "cow\n"), ("words.map", "x\n")]:
+            with open(os.path.join(tmp_dir, name), "w", encoding="utf8") as fout:
+                fout.write(text)
+        assert read_words(tmp_dir) == {"cat", "dog", "cow"}
+
+
+if __name__ == "__main__":
+    test_word_index()
+    test_empty_and_invalid_index()
+    test_read_words()
@@ -0,0 +1,71 @@
+import random
+
+from gector.lru_cache import LRUCache
+from gector.wordpiece_indexer import WordpieceIndexer
+
+
+def _merge_loop_bpe(token, bpe_ranks):
+    # the classic BPE loop, which rescans the word after every merge
+    word = tuple(token)
+    while len(word) > 1:
+        pairs = set(zip(word, word[1:]))
+        bigram = min(pairs, key=lambda pair: bpe_ranks.get(pair, float("inf")))
+        if bigram not in bpe_ranks:
+            break
+        first, second = bigram
+        new_word, i = [], 0
+        while i < len(word):
+            if word[i] == first and i < len(word) - 1 and word[i + 1] == second:
+                new_word.append(first + second)
+                i += 2
+            else:
+                new_word.append(word[i])
+                i += 1
+        word = tuple(new_word)
+    return " ".join(word)
+
+
+def _random_ranks(rng, alphabet, merges_number):
+    symbols = list(alphabet)
+    bpe_ranks = {}
+    while len(bpe_ranks) < merges_number:
+        pair = (rng.choice(symbols), rng.choice(symbols))
+        if pair not in bpe_ranks:
+            bpe_ranks[pair] = len(bpe_ranks)
+            symbols.append(pair[0] + pair[1])
+    return bpe_ranks
+
+
+def _get_indexer(bpe_ranks, cache_size=100):
+    # only the fields used by ``bpe``, the vocabulary and the tokenizer are not needed
+    indexer = WordpieceIndexer.__new__(WordpieceIndexer)
+    indexer.bpe_ranks = bpe_ranks
+    indexer.cache = LRUCache(cache_size)
+    return indexer
+
+
+def test_bpe():
+    rng = random.Random(0)
+    for alphabet in ["ab", "abcd", "abcdefgh"]:
+        bpe_ranks = _random_ranks(rng, alphabet, 4 * len(alphabet) ** 2 // 3)
+        indexer = _get_indexer(bpe_ranks)
+        for _ in range(2000):
+            token = "".join(rng.choice(alphabet) for _ in range(rng.randint(1, 16)))
+            expected = _merge_loop_bpe(token, bpe_ranks)
+            assert indexer.bpe(token) == expected, token
+            # the second call is answered by the cache
+            assert indexer.bpe(token) == expected, token
+        assert len(indexer.cache) <= 100
+
+
+def test_bpe_repeated_pairs():
+    # all occurrences of the best pair are merged from left to right
+    indexer = _get_indexer({("a", "a"): 0, ("aa", "a"): 1, ("aa", "aa"): 2})
+    for length in range(1, 12):
+        token = "a" * length
+        assert indexer.bpe(token) == _merge_loop_bpe(token, indexer.bpe_ranks), token
+
+
+if __name__ == "__main__":
+    test_bpe()
+    test_bpe_repeated_pairs()
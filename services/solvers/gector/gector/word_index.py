@@ -0,0 +1,80 @@
+"""Memory-mapped sorted word list for membership checks shared between worker processes"""
+import bisect
+import mmap
+import os
+import struct
+
+import numpy as np
+
+MAGIC = b"WORDIDX1"
+# magic and the number of words
+HEADER = struct.Struct("<8sI")
+
+
+def read_words(folderpath, bad_suffixes=None):
+    """
+    Reads the words from all files of the folder, except the files with ``bad_suffixes``.
+    """
+    if bad_suffixes is None:
+        bad_suffixes = ["map"]
+    filepaths = [
+        os.path.join(folderpath, f) for f in os.listdir(folderpath) if not any(f.endswith(x) for x in bad_suffixes)
+    ]
+    words = []
+    for filepath in filepaths:
+        with open(filepath, "r", encoding="utf8") as f:
+            data = f.readlines()
+        words.extend([x.strip() for x in data])
+    return set(words)
+
+
+def build_word_index(words, path):
+    """
+    Writes the header, the offsets of the words and the blob of the utf8 encoded words sorted bytewise.
+    The file is written to a temporary path and renamed, so that running workers never see a partial index.
+    """
+    encoded = sorted(set(word.encode("utf8") for word in words))
+    offsets = np.zeros(len(encoded) + 1, dtype="<u8")
+    np.cumsum([len(word) for word in encoded], out=offsets[1:])
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "wb") as fout:
+        fout.write(HEADER.pack(MAGIC, len(encoded)))
+        fout.write(offsets.tobytes())
+        fout.write(b"".join(encoded))
+    os.replace(tmp_path, path)
+
+
+class WordIndex(object):
+    """
+    Read-only set of words backed by a file built with ``build_word_index``.
+    The file is memory-mapped, so its pages are shared by all processes that open it,
+    membership is checked by a binary search over the raw bytes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as fin:
+            self._mmap = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._size = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a word index")
+        self._offsets = np.frombuffer(self._mmap, dtype="<u8", count=self._size + 1, offset=HEADER.size)
+        self._blob_start = HEADER.size + self._offsets.nbytes
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, i):
+        if not 0 <= i < self._size:
+            raise IndexError(i)
+        start = self._blob_start + int(self._offsets[i])
+        end = self._blob_start + int(self._offsets[i + 1])
+        return self._mmap[start:end]
+
+    def __contains__(self, word):
+        if not isinstance(word, str):
+            return False
+        key = word.encode("utf8")
+        i = bisect.bisect_left(self, key)
+        return i < self._size and self[i] == key
@@ -1,4 +1,7 @@
 """Tweaked version of corresponding AllenNLP file"""
+import hashlib
+import heapq
+import json
 import logging
 from collections import defaultdict
 from typing import Callable, Dict, List
@@ -8,6 +11,7 @@ from allennlp.data.token_indexers.token_indexer import TokenIndexer
 from allennlp.data.tokenizers.token import Token
 from allennlp.data.vocabulary import Vocabulary
 from overrides import overrides
+from gector.lru_cache import LRUCache
 from transformers import AutoTokenizer
 from utils.helpers import START_TOKEN
 
@@ -63,6 +67,8 @@ class WordpieceIndexer(TokenIndexer[int]):
         sliding window.
     token_min_padding_length : ``int``, optional (default=``0``)
         See :class:`TokenIndexer`.
+    bpe_cache_size : ``int``, optional (default=``100000``)
+        Maximal number of tokens in the LRU cache of BPE results, ``None`` means unbounded cache.
     """
 
     def __init__(
@@ -82,6 +88,7 @@ class WordpieceIndexer(TokenIndexer[int]):
         end_tokens: List[str] = None,
         truncate_long_sequences: bool = True,
         token_min_padding_length: int = 0,
+        bpe_cache_size: int = 100000,
     ) -> None:
         super().__init__(token_min_padding_length)
         self.vocab = vocab
@@ -100,9 +107,15 @@ class WordpieceIndexer(TokenIndexer[int]):
         self._truncate_long_sequences = truncate_long_sequences
         self.max_pieces_per_sentence = 80
         self.is_test = is_test
-        self.cache = {}
+        self.cache = LRUCache(bpe_cache_size)
+        # token -> wordpiece ids, is enabled by GecBERTModel for the time of a single ``handle_batch`` call,
+        # so that the tokens left unchanged by a correction iteration are not tokenized again
+        self.token_ids_cache = None
+        self.token_cache_hits = 0
+        self.token_cache_misses = 0
         self.bpe_ranks = bpe_ranks
         self.byte_encoder = byte_encoder
+        self._fingerprint = None
 
         if self.is_test:
             self.max_pieces_per_token = None
@@ -121,6 +134,30 @@ class WordpieceIndexer(TokenIndexer[int]):
             vocab[wordpiece] for token in (end_tokens or []) for wordpiece in wordpiece_tokenizer(token)
         ]
 
+    @property
+    def fingerprint(self) -> str:
+        """
+        Hash of everything that defines the output of ``texts_to_indices``.
+        Indexers with equal fingerprints produce identical wordpiece ids and offsets.
+        """
+        if self._fingerprint is None:
+            tokenizer = getattr(self.wordpiece_tokenizer, "__self__", self.wordpiece_tokenizer)
+            config = [
+                type(tokenizer).__name__,
+                sorted(self.vocab.items()),
+                [" ".join(pair) for pair, _ in sorted(self.bpe_ranks.items(), key=lambda x: x[1])],
+                self._start_piece_ids,
+                self._end_piece_ids,
+                self.use_starting_offsets,
+                self.max_pieces,
+                self.max_pieces_per_token,
+                self._do_lowercase,
+                sorted(self._never_lowercase),
+                self._truncate_long_sequences,
+            ]
+            self._fingerprint = hashlib.md5(json.dumps(config, ensure_ascii=False).encode("utf8")).hexdigest()
+        return self._fingerprint
+
     @overrides
     def count_vocab_items(self, token: Token, counter: Dict[str, Dict[str, int]]):
         # If we only use pretrained models, we don't need to do anything here.
@@ -145,46 +182,64 @@ class WordpieceIndexer(TokenIndexer[int]):
         return pairs
 
     def bpe(self, token):
-        if token in self.cache:
-            return self.cache[token]
-        word = tuple(token)
-        pairs = self.get_pairs(word)
+        """
+        Applies BPE merges to the token, the output is the same as of the classic merge loop.
 
-        if not pairs:
+        Symbols are kept in a linked list and candidate pairs in a priority queue ordered by (rank, position),
+        so every step pops the best pair instead of rescanning the whole word.
+        All occurrences of the best pair are merged from left to right before the next rank is considered.
+        """
+        word = self.cache.get(token)
+        if word is not None:
+            return word
+        symbols = list(token)
+        if len(symbols) < 2:
             return token
 
-        while True:
-            bigram = min(pairs, key=lambda pair: self.bpe_ranks.get(pair, float("inf")))
-            if bigram not in self.bpe_ranks:
-                break
-            first, second = bigram
-            new_word = []
-            i = 0
-            while i < len(word):
-                try:
-                    j = word.index(first, i)
-                    new_word.extend(word[i:j])
-                    i = j
-                except:
-                    new_word.extend(word[i:])
-                    break
-
-                if word[i] == first and i < len(word) - 1 and word[i + 1] == second:
-                    new_word.append(first + second)
-                    i += 2
-                else:
-                    new_word.append(word[i])
-                    i += 1
-            new_word = tuple(new_word)
-            word = new_word
-            if len(word) == 1:
-                break
-            else:
-                pairs = self.get_pairs(word)
-        word = " ".join(word)
-        self.cache[token] = word
+        next_ids = list(range(1, len(symbols))) + [-1]
+        prev_ids = list(range(-1, len(symbols) - 1))
+        heap = []
+        for i in range(len(symbols) - 1):
+            rank = self.bpe_ranks.get((symbols[i], symbols[i + 1]))
+            if rank is not None:
+                heap.append((rank, i, symbols[i], symbols[i + 1]))
+        heapq.heapify(heap)
+
+        while heap:
+            rank = heap[0][0]
+            candidates = []
+            while heap and heap[0][0] == rank:
+                candidates.append(heapq.heappop(heap))
+            for _, i, first, second in candidates:
+                j = next_ids[i]
+                # the pair is outdated by one of the previous merges
+                if symbols[i] != first or j == -1 or symbols[j] != second:
+                    continue
+                symbols[i], symbols[j] = first + second, None
+                k = next_ids[j]
+                next_ids[i] = k
+                if k != -1:
+                    prev_ids[k] = i
+                for left, right in ((prev_ids[i], i), (i, k)):
+                    if left == -1 or right == -1:
+                        continue
+                    new_rank = self.bpe_ranks.get((symbols[left], symbols[right]))
+                    if new_rank is not None:
+                        heapq.heappush(heap, (new_rank, left, symbols[left], symbols[right]))
+
+        word = " ".join(symbol for symbol in symbols if symbol is not None)
+        self.cache.put(token, word)
         return word
 
+    def warm_up(self, words):
+        """
+        Fills the BPE cache with the most frequent words, so that a restarted worker does not tokenize them again.
+        """
+        if self.bpe_ranks == {}:
+            return
+        for word in words:
+            self.bpe_tokenize(word)
+
     def bpe_tokenize(self, text):
         """ Tokenize a string."""
         bpe_tokens = []
@@ -193,27 +248,56 @@ class WordpieceIndexer(TokenIndexer[int]):
             bpe_tokens.extend(bpe_token for bpe_token in self.bpe(token).split(" "))
         return bpe_tokens
 
+    def _tokenize_token(self, text):
+        if self.bpe_ranks != {}:
+            return self.bpe_tokenize(text)
+        return self.wordpiece_tokenizer(text)
+
+    def token_to_wordpiece_ids(self, text: str) -> List[int]:
+        if self.token_ids_cache is not None:
+            wordpiece_ids = self.token_ids_cache.get(text)
+            if wordpiece_ids is not None:
+                self.token_cache_hits += 1
+                return wordpiece_ids
+        wps = self._tokenize_token(text)
+        wordpiece_ids = [self.vocab[wordpiece] for wordpiece in wps][: self.max_pieces_per_token]
+        if self.token_ids_cache is not None:
+            self.token_cache_misses += 1
+            self.token_ids_cache[text] = wordpiece_ids
+        return wordpiece_ids
+
+    def count_pieces(self, tokens: List[str]) -> int:
+        """
+        Returns the number of wordpieces of the token strings, excluding start and end pieces.
+        """
+        count = 0
+        for token in tokens:
+            if self._do_lowercase and token not in self._never_lowercase:
+                token = token.lower()
+            count += len(self.token_to_wordpiece_ids(token))
+        return count
+
     @overrides
     def tokens_to_indices(self, tokens: List[Token], vocabulary: Vocabulary, index_name: str) -> Dict[str, List[int]]:
         if not self._added_to_vocabulary:
             self._add_encoding_to_vocabulary(vocabulary)
             self._added_to_vocabulary = True
+        return self.texts_to_indices([token.text for token in tokens], index_name)
 
+    def texts_to_indices(self, texts: List[str], index_name: str) -> Dict[str, List[int]]:
+        """
+        The same as ``tokens_to_indices``, but works with token strings
+        and does not require AllenNLP ``Token`` objects and ``Vocabulary``.
+        """
         # This lowercases tokens if necessary
         text = (
-            token.text.lower() if self._do_lowercase and token.text not in self._never_lowercase else token.text
-            for token in tokens
+            token.lower() if self._do_lowercase and token not in self._never_lowercase else token for token in texts
         )
 
         # Obtain a nested sequence of wordpieces, each represented by a list of wordpiece ids
         token_wordpiece_ids = []
         for token in text:
-            if self.bpe_ranks != {}:
-                wps = self.bpe_tokenize(token)
-            else:
-                wps = self.wordpiece_tokenizer(token)
-            limited_wps = [self.vocab[wordpiece] for wordpiece in wps][: self.max_pieces_per_token]
-            token_wordpiece_ids.append(limited_wps)
+            token_wordpiece_ids.append(self.token_to_wordpiece_ids(token))
 
         # Flattened list of wordpieces. In the end, the output of the model (e.g., BERT) should
         # have a sequence length equal to the length of this list. However, it will first be split into
@@ -283,7 +367,7 @@ class WordpieceIndexer(TokenIndexer[int]):
             logger.warning(
                 "Too many wordpieces, truncating sequence. If you would like a sliding window, set"
                 "`truncate_long_sequences` to False %s",
-                str([token.text for token in tokens]),
+                str(texts),
             )
             wordpiece_windows = [self._add_start_and_end(flat_wordpiece_ids[:window_length])]
         else:
@@ -383,6 +467,8 @@ class PretrainedBertIndexer(WordpieceIndexer):
         By default, long sequences will be truncated to the maximum sequence
         length. Otherwise, they will be split apart and batched using a
         sliding window.
+    bpe_cache_size : ``int``, optional (default=``100000``)
+        Maximal number of tokens in the LRU cache of BPE results, ``None`` means unbounded cache.
     """
 
     def __init__(
@@ -396,6 +482,7 @@ class PretrainedBertIndexer(WordpieceIndexer):
         is_test=False,
         truncate_long_sequences: bool = True,
         special_tokens_fix: int = 0,
+        bpe_cache_size: int = 100000,
     ) -> None:
         if pretrained_model.endswith("-cased") and do_lowercase:
             logger.warning("Your BERT model appears to be cased, " "but your indexer is lowercasing tokens.")
@@ -440,4 +527,5 @@ class PretrainedBertIndexer(WordpieceIndexer):
             start_tokens=["[CLS]"] if not special_tokens_fix else [],
             end_tokens=["[SEP]"] if not special_tokens_fix else [],
             truncate_long_sequences=truncate_long_sequences,
+            bpe_cache_size=bpe_cache_size,
         )
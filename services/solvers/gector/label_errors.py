@@ -1,17 +1,32 @@
-import difflib
+import logging
 import os
 import re
+import threading
 from string import punctuation
 
 import spacy
-from cp_data_readers.utils import _word_tokenize
+from alignment import align, tokenize
+from cp_batching.scheduler import BatchScheduler
 from gector.gec_model import GecBERTModel
+from gector.lru_cache import LRUCache
+from gector.result_cache import CorrectionCache
+from gector.word_index import WordIndex, read_words
 from sacremoses import MosesDetokenizer
 
+logger = logging.getLogger(__file__)
+
 # для этого есть функция is_punctuation в utils ридера, замените
 punct = punctuation + "«»—…“”*№–"
 
+# the tagger and the parser provide pos_, tag_, lemma_ and dep_ used in classify_changes
 spacy_model = spacy.load("en", disable=["ner"])
+spacy_batch_size = int(os.getenv("GECTOR_SPACY_BATCH_SIZE", 64))
+# the spaCy Language is not thread-safe, the request threads of gunicorn use it one at a time
+spacy_lock = threading.Lock()
+
+# POS tags of single tokens do not depend on the context, so they are tagged without the parser and cached
+pos_cache = LRUCache(int(os.getenv("GECTOR_POS_CACHE_SIZE", 100000)))
+pos_cache_lock = threading.Lock()
 
 md = MosesDetokenizer(lang="en")
 
@@ -22,6 +37,32 @@ model = GecBERTModel(
     model_name="roberta",
     special_tokens_fix=0,
     is_ensemble=True,
+    batch_size=int(os.getenv("GECTOR_BATCH_SIZE", 64)),
+    max_batch_pieces=int(os.getenv("GECTOR_MAX_BATCH_PIECES", 0)) or None,
+    sort_by_length=True,
+    bpe_cache_size=int(os.getenv("GECTOR_BPE_CACHE_SIZE", 100000)),
+    bpe_warmup_file=os.getenv("GECTOR_BPE_WARMUP_FILE"),
+    backend=os.getenv("GECTOR_BACKEND", "eager"),
+    backend_cache_dir=os.getenv("GECTOR_BACKEND_CACHE_DIR", "/root/.cache/gector"),
+    backend_validation_dir=os.getenv("GECTOR_BACKEND_VALIDATION_DIR", "test_data"),
+)
+
+# corrected sentences are cached in memory and optionally in a SQLite database
+result_cache_size = int(os.getenv("GECTOR_RESULT_CACHE_SIZE", 100000))
+result_cache = None
+if result_cache_size:
+    result_cache = CorrectionCache(
+        model.fingerprint, maxsize=result_cache_size, db_path=os.getenv("GECTOR_RESULT_CACHE_DB")
+    )
+
+# sentences from all paragraphs, instances and concurrent requests are batched together
+scheduler = BatchScheduler(
+    lambda batch: model.handle_batch(batch)[0],
+    cache=result_cache,
+    max_wait=float(os.getenv("GECTOR_BATCH_WAIT", 0.01)),
+    max_sentences=int(os.getenv("GECTOR_MAX_PENDING_SENTENCES", 512)),
+    log_interval=float(os.getenv("GECTOR_LOG_INTERVAL", 60)),
+    name="gector-scheduler",
 )
 
 ENG_PRONOUNS = {
@@ -166,62 +207,141 @@ FP_LEX_VERBS_TO_GRAM = {
     "could",
 }
 
+# POS of the words replaced with a lexical error
+LEX_POS = {"NOUN", "ADJ", "VERB"}
+
+# singular and plural noun tags
+NUMBER_TAG_PAIRS = {("NN", "NNS"), ("NNS", "NN")}
+
+# dependencies of an inserted subject or predicate
+ROOT_DEPS = {"ROOT", "nsubj"}
+
+# type, subtype and explanation of the error classes
+LABELS = {
+    "орф": {"type": "А.орф", "subtype": "", "explanation": "Орфографическая ошибка."},
+    "мест": {"type": "А.грамм", "subtype": "мест", "explanation": "Местоимение"},
+    "прит": {"type": "А.грамм", "subtype": "прит", "explanation": "Форма притяжательного падежа существительного"},
+    "видовр": {"type": "А.грамм", "subtype": "видовр", "explanation": "Видовременная форма глагола"},
+    "конт": {
+        "type": "А.лекс",
+        "subtype": "конт",
+        "explanation": "Лексическая ошибка. Неправильное употребление слова в контексте",
+    },
+    "пред": {"type": "А.грамм", "subtype": "пред", "explanation": "Предлог"},
+    "мод": {"type": "А.грамм", "subtype": "мод", "explanation": "Модальный глагол"},
+    "множ": {"type": "А.грамм", "subtype": "множ", "explanation": "Форма множественного числа"},
+    "арт": {"type": "А.грамм", "subtype": "арт", "explanation": "Артикль"},
+    "сравн": {
+        "type": "А.грамм",
+        "subtype": "сравн",
+        "explanation": "Форма степени сравнения прилагательного или наречия",
+    },
+    "поряд": {"type": "А.грамм", "subtype": "поряд", "explanation": "Порядок слов в предложении"},
+    "проп": {
+        "type": "А.грамм",
+        "subtype": "проп",
+        "explanation": "Пропуск слова (подлежащего или сказуемого), влияющий на грамматическую структуру предложения",
+    },
+}
+
+PUNCT_TABLE = str.maketrans("", "", punct)
+PUNCT_CHARS = set(punct)
+# a punctuation mark between words or after a word
+SPLIT_WORD_RE = re.compile(r"\w*[.,?!]\s*\w+")
+WORD_PUNCT_RE = re.compile(r"\w+[.,?!]")
+# matches the linkers anywhere inside the words, as the substring check did
+LINKERS_RE = re.compile("|".join(re.escape(linker) for linker in sorted(ENG_LINKERS, key=len, reverse=True)))
+
+
+# the dictionary is memory-mapped from the index built by build_dictionary.py, so that workers share it
+dictionary_dir = "/data/dictionaries/scowl_70"
+dictionary_index = os.getenv("GECTOR_DICTIONARY_INDEX", "/root/.cache/gector/scowl_70.idx")
+if os.path.exists(dictionary_index):
+    words = WordIndex(dictionary_index)
+else:
+    logger.warning(f"{dictionary_index} is not found, {dictionary_dir} is loaded to memory")
+    words = read_words(dictionary_dir)
+
 
-def read_data(folderpath, bad_suffixes=None):
-    if bad_suffixes is None:
-        bad_suffixes = ["map"]
-    filepaths = [
-        os.path.join(folderpath, f) for f in os.listdir(folderpath) if not any(f.endswith(x) for x in bad_suffixes)
-    ]
-    words = []
-    for filepath in filepaths:
-        with open(filepath, "r", encoding="utf8") as f:
-            data = f.readlines()
-        words.extend([x.strip() for x in data])
-    return set(words)
-
-
-words = read_data("/data/dictionaries/scowl_70")
-
-
-def predict_corrections(input_data, model=model, batch_size=64):
-    predictions = []
-    batch = []
-    for sent in input_data:
-        batch.append(sent["words"])
-        if len(batch) == batch_size:
-            preds, cnt = model.handle_batch(batch)
-            predictions.extend(preds)
-            batch = []
-    if batch:
-        preds, cnt = model.handle_batch(batch)
-        predictions.extend(preds)
+def submit_corrections(input_data, scheduler=scheduler):
+    """Enqueues sentences for correction, returns a future with corrected word lists"""
+    return scheduler.submit([sent["words"] for sent in input_data])
+
+
+def get_cache_stats():
+    return {
+        "result_cache": result_cache.stats() if result_cache is not None else None,
+        "bpe_caches": model.get_cache_stats(),
+        "pos_cache": pos_cache.stats(),
+    }
+
+
+def parse_sentences(texts):
+    """
+    Parses the texts with a single ``nlp.pipe`` call, returns a dict text -> Doc.
+    Repeated texts are parsed once.
+    """
+    unique_texts = list(dict.fromkeys(texts))
+    with spacy_lock:
+        docs = list(spacy_model.pipe(unique_texts, batch_size=spacy_batch_size))
+    return dict(zip(unique_texts, docs))
+
+
+def get_pos_tags(text):
+    """Cached POS tags of the spaCy tokens of a single word"""
+    with pos_cache_lock:
+        tags = pos_cache.get(text)
+    if tags is None:
+        with spacy_lock:
+            doc = next(spacy_model.pipe([text], disable=["parser"]))
+        tags = tuple(token.pos_ for token in doc)
+        with pos_cache_lock:
+            pos_cache.put(text, tags)
+    return tags
+
+
+def detokenize_corrections(predictions):
     return [md.detokenize(x) for x in predictions]
 
 
+def predict_corrections(input_data, scheduler=scheduler):
+    return detokenize_corrections(submit_corrections(input_data, scheduler).result())
+
+
 def _get_opcodes(before, after):
-    if isinstance(before, str):
-        before = _word_tokenize(before)[0]
-    if isinstance(after, str):
-        after = _word_tokenize(after)[0]
-    s = difflib.SequenceMatcher(None, before, after)
-    opcodes = []
-    for tag, i1, i2, j1, j2 in s.get_opcodes():
-        if tag != "equal":
-            opcodes.append([tag, (i1, i2), (j1, j2), before[i1:i2], after[j1:j2]])
-    return opcodes, before, after
-
-
-def classify_changes(opcodes, before, after, word_offsets, before_text):
-    before_parsed, after_parsed = spacy_model(before), spacy_model(after)
-    before, after = _word_tokenize(before)[0], _word_tokenize(after)[0]
+    return align(before, after)
+
+
+def _normalize(word):
+    return word.lower().translate(PUNCT_TABLE)
+
+
+def _is_one_word(words):
+    return all(not SPLIT_WORD_RE.search(x) and not WORD_PUNCT_RE.search(x) for x in words)
+
+
+def _set_label(correction, label, **kwargs):
+    correction.update(LABELS[label], **kwargs)
+
+
+def classify_changes(
+    opcodes, before, after, word_offsets, before_text, parsed=None, before_words=None, after_words=None
+):
+    """
+    ``before_words`` and ``after_words`` are the words of the sentences if they are already tokenized.
+    """
+    if parsed is None:
+        parsed = parse_sentences([before, after])
+    before_parsed, after_parsed = parsed[before], parsed[after]
+    before = before_words if before_words is not None else tokenize(before)
+    after = after_words if after_words is not None else tokenize(after)
     corrections = []
     skip = False
     for i, item in enumerate(opcodes):
         if skip:
             skip = False
             continue
-        if "(" in item[3] or any(e in x.lower() for e in ENG_LINKERS for x in item[3]):
+        if "(" in item[3] or LINKERS_RE.search("\n".join(item[3]).lower()):
             continue
         correction = {"comment": "", "subtype": "", "group": "error", "tag": ""}
         start, end = item[1]
@@ -229,126 +349,70 @@ def classify_changes(opcodes, before, after, word_offsets, before_text):
             correction["startSelection"] = word_offsets[start][0]
             correction["endSelection"] = word_offsets[end - 1][1]
             correction["correction"] = md.detokenize(item[4])
-            normalized_error = item[3][0].lower().translate(str.maketrans("", "", punct))
-            normalized_correction = item[4][0].lower().translate(str.maketrans("", "", punct))
+            normalized_error = _normalize(item[3][0])
+            normalized_correction = _normalize(item[4][0])
             if normalized_error in ENG_PRONOUNS and normalized_correction in ENG_PRONOUNS:
-                if normalized_error == normalized_correction:
-                    correction["type"] = "А.орф"
-                    correction["explanation"] = "Орфографическая ошибка."
-                else:
-                    correction["type"] = "А.грамм"
-                    correction["subtype"] = "мест"
-                    correction["explanation"] = "Местоимение"
-            elif all(not re.search("\w*[.,?!]\s*\w+", x) for x in item[3]) and all(
-                not re.search("\w+[.,?!]", x) for x in item[3]
-            ):
+                _set_label(correction, "орф" if normalized_error == normalized_correction else "мест")
+            elif _is_one_word(item[3]):
                 if len(item[3]) == len(item[4]):
                     if "'s" in item[3][0] or "'s" in item[4][0]:
-                        correction["type"] = "А.грамм"
-                        correction["subtype"] = "прит"
-                        correction["explanation"] = "Форма притяжательного падежа существительного"
+                        _set_label(correction, "прит")
                     elif normalized_error == normalized_correction or normalized_error not in words:
-                        correction["type"] = "А.орф"
-                        correction["explanation"] = "Орфографическая ошибка."
+                        _set_label(correction, "орф")
                     else:
-                        before_pos = before_parsed[item[1][0]].pos_
-                        after_pos = after_parsed[item[2][0]].pos_
-                        if before_parsed[item[1][0]].lemma_ != after_parsed[item[2][0]].lemma_ and (
-                            before_pos == after_pos == "NOUN"
-                            or before_pos == after_pos == "ADJ"
-                            or before_pos == after_pos == "VERB"
-                        ):
-                            if after_parsed[item[2][0]].lemma_ in FP_LEX_WORDS:
+                        before_token, after_token = before_parsed[item[1][0]], after_parsed[item[2][0]]
+                        before_pos, after_pos = before_token.pos_, after_token.pos_
+                        if before_token.lemma_ != after_token.lemma_ and before_pos == after_pos in LEX_POS:
+                            if after_token.lemma_ in FP_LEX_WORDS:
                                 continue
-                            elif after_parsed[item[2][0]].lemma_ in FP_LEX_VERBS_TO_GRAM:
-                                correction["type"] = "А.грамм"
-                                correction["subtype"] = "видовр"
-                                correction["explanation"] = "Видовременная форма глагола"
+                            elif after_token.lemma_ in FP_LEX_VERBS_TO_GRAM:
+                                _set_label(correction, "видовр")
                             else:
-                                correction["type"] = "А.лекс"
-                                correction["subtype"] = "конт"
-                                correction[
-                                    "explanation"
-                                ] = "Лексическая ошибка. Неправильное употребление слова в контексте"
+                                _set_label(correction, "конт")
                         elif before_pos == after_pos == "ADP":
-                            correction["type"] = "А.грамм"
-                            correction["subtype"] = "пред"
-                            correction["explanation"] = "Предлог"
+                            _set_label(correction, "пред")
                         elif after[item[2][0]] in ENG_MODAL_VERBS:
-                            correction["type"] = "А.грамм"
-                            correction["subtype"] = "мод"
-                            correction["explanation"] = "Модальный глагол"
-                        elif any(x in punct for x in item[4][0]):
+                            _set_label(correction, "мод")
+                        elif not PUNCT_CHARS.isdisjoint(item[4][0]):
                             continue
-                        elif (before_parsed[item[1][0]].tag_ == "NN" and after_parsed[item[2][0]].tag_ == "NNS") or (
-                            before_parsed[item[1][0]].tag_ == "NNS" and after_parsed[item[2][0]].tag_ == "NN"
-                        ):
+                        elif (before_token.tag_, after_token.tag_) in NUMBER_TAG_PAIRS:
                             if item[4][0] in FP_PLURAL_NOUNS:
                                 continue
-                            correction["type"] = "А.грамм"
-                            correction["subtype"] = "множ"
-                            correction["explanation"] = "Форма множественного числа"
+                            _set_label(correction, "множ")
                         else:
-                            correction["type"] = "А.грамм"
-                            correction["subtype"] = "видовр"
-                            correction["explanation"] = "Видовременная форма глагола"
+                            _set_label(correction, "видовр")
                 elif len(item[3]) < len(item[4]):
-                    if normalized_correction in ENG_ARTICLES:
-                        correction["type"] = "А.грамм"
-                        correction["subtype"] = "арт"
-                        correction["explanation"] = "Артикль"
-                    else:
-                        correction["type"] = "А.грамм"
-                        correction["subtype"] = "видовр"
-                        correction["explanation"] = "Видовременная форма глагола"
+                    _set_label(correction, "арт" if normalized_correction in ENG_ARTICLES else "видовр")
                 else:
-                    if normalized_error in ENG_ARTICLES:
-                        correction["type"] = "А.грамм"
-                        correction["subtype"] = "арт"
-                        correction["explanation"] = "Артикль"
-                    else:
-                        correction["type"] = "А.грамм"
-                        correction["subtype"] = "видовр"
-                        correction["explanation"] = "Видовременная форма глагола"
+                    _set_label(correction, "арт" if normalized_error in ENG_ARTICLES else "видовр")
         elif "delete" == item[0]:
             if not item[3] and not item[4]:
                 continue
             correction["type"] = "А.грамм"
-            normalized_error = item[3][0].lower().translate(str.maketrans("", "", punct))
-            if len(item[3]) == 1:
-                if normalized_error in ENG_ARTICLES:
-                    item[4].append(before[end])
-                    end += 1
-                    if item[4][-1] in ENG_ADJ_COMP or item[4][-1].endswith("est"):
-                        correction["subtype"] = "сравн"
-                    else:
-                        correction["subtype"] = "арт"
-                        correction["explanation"] = "Артикль"
-                elif item[3][0] in punct:
-                    start -= 1
-                    item[4].insert(0, before[start])
-                    correction["type"] = "А.пункт"
-                    continue  # выключили пунктуацию
-                elif spacy_model(item[3][0])[0].pos_ == "ADP":
-                    correction["subtype"] = "пред"
-                    correction["explanation"] = "Предлог"
+            normalized_error = _normalize(item[3][0])
+            if len(item[3]) == 1 and normalized_error in ENG_ARTICLES:
+                item[4].append(before[end])
+                end += 1
+                if item[4][-1] in ENG_ADJ_COMP or item[4][-1].endswith("est"):
+                    correction["subtype"] = "сравн"
                 else:
-                    correction["subtype"] = "видовр"
-                    correction["explanation"] = "Видовременная форма глагола"
+                    _set_label(correction, "арт")
+            elif len(item[3]) == 1 and item[3][0] in punct:
+                start -= 1
+                item[4].insert(0, before[start])
+                correction["type"] = "А.пункт"
+                continue  # выключили пунктуацию
+            elif get_pos_tags(item[3][0])[0] == "ADP":
+                _set_label(correction, "пред")
             else:
-                if spacy_model(item[3][0])[0].pos_ == "ADP":
-                    correction["subtype"] = "пред"
-                    correction["explanation"] = "Предлог"
-                else:
-                    correction["subtype"] = "видовр"
-                    correction["explanation"] = "Видовременная форма глагола"
+                _set_label(correction, "видовр")
             correction["startSelection"] = word_offsets[start][0]
             correction["endSelection"] = word_offsets[end - 1][1]
             correction["correction"] = md.detokenize(item[4])
         elif "insert" == item[0]:
-            normalized_correction = item[4][0].lower().translate(str.maketrans("", "", punct))
+            normalized_correction = _normalize(item[4][0])
             correction["type"] = "А.грамм"
-            after_pos = "".join([token.pos_ for token in spacy_model(normalized_correction)])
+            after_pos = "".join(get_pos_tags(normalized_correction))
             if item[4][0] in punct and item[2][0] != len(before):
                 start -= 1
                 if before[start].lower() in FP_PUNCT_WORDS:
@@ -360,41 +424,30 @@ def classify_changes(opcodes, before, after, word_offsets, before_text):
                 item[4].append(before[end])
                 end += 1
                 if item[4][-1] in ENG_ADJ_COMP or item[4][-1].endswith("est"):
-                    correction["subtype"] = "сравн"
-                    correction["explanation"] = "Форма степени сравнения прилагательного или наречия"
+                    _set_label(correction, "сравн")
                 else:
-                    correction["subtype"] = "арт"
-                    correction["explanation"] = f"Пропущен артикль {normalized_correction}"
+                    _set_label(correction, "арт", explanation=f"Пропущен артикль {normalized_correction}")
             elif after_pos == "ADP":
                 start -= 1
                 item[4].insert(0, before[start])
-                correction["subtype"] = "пред"
-                correction["explanation"] = f"Пропущен предлог {normalized_correction}"
+                _set_label(correction, "пред", explanation=f"Пропущен предлог {normalized_correction}")
             else:
-                correction["type"] = "А.грамм"
                 if i + 1 < len(opcodes) and item[3:][::-1] == opcodes[i + 1][3:]:
                     skip = True
                     _start, _end = opcodes[i + 1][1]
                     item[4].extend(before[end:_start])
                     end = _end
-                    correction["subtype"] = "поряд"
-                    correction["explanation"] = "Порядок слов в предложении"
-                elif ("ROOT" in [x.dep_ for x in after_parsed[item[2][0] : item[2][1] + 1]]) or (
-                    "nsubj" in [x.dep_ for x in after_parsed[item[2][0] : item[2][1] + 1]]
-                ):
+                    _set_label(correction, "поряд")
+                elif not ROOT_DEPS.isdisjoint(x.dep_ for x in after_parsed[item[2][0] : item[2][1] + 1]):
                     if end >= len(before):
                         continue
                     item[4].append(before[end])
                     end += 1
-                    correction["subtype"] = "проп"
-                    correction[
-                        "explanation"
-                    ] = "Пропуск слова (подлежащего или сказуемого), влияющий на грамматическую структуру предложения"
+                    _set_label(correction, "проп")
                 else:
                     start -= 1
                     item[4].insert(0, before[start])
-                    correction["subtype"] = "видовр"
-                    correction["explanation"] = "Видовременная форма глагола"
+                    _set_label(correction, "видовр")
             correction["startSelection"] = word_offsets[start][0]
             if end > start:
                 correction["endSelection"] = word_offsets[end - 1][1]
@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import itertools
 import logging
 import os
 import time
@@ -21,7 +22,14 @@ from cp_data_store import store
 from cp_index_map.index_map import compose_map, make_map_from_spans
 from flask import Flask, jsonify, request
 from healthcheck import HealthCheck
-from label_errors import _get_opcodes, classify_changes, predict_corrections
+from label_errors import (
+    _get_opcodes,
+    classify_changes,
+    detokenize_corrections,
+    get_cache_stats,
+    parse_sentences,
+    submit_corrections,
+)
 
 SERVICE_NAME = os.getenv("SERVICE_NAME", "gector")
 SERVICE_PORT = int(os.getenv("SERVICE_PORT", 2102))
@@ -46,8 +54,44 @@ health = HealthCheck(app, "/healthcheck")
 subject_name = "английский"
 
 
-def handler(instance):
-    if instance["instance_info"]["subject"] not in ["eng"]:
+def is_supported(instance):
+    return instance["instance_info"]["subject"] in ["eng"]
+
+
+def submit_instance(instance):
+    """
+    Enqueues all sentences of the instance to the gector batch scheduler,
+    so that sentences of all instances and concurrent requests are corrected together.
+    """
+    if not is_supported(instance):
+        return None
+    curr_sentences = instance["annotations"]["contraction_corrector"]["essay_sentences"]
+    return submit_corrections(list(itertools.chain.from_iterable(curr_sentences)))
+
+
+def get_corrected_sentences(corrections_future):
+    if corrections_future is None:
+        return None
+    return detokenize_corrections(corrections_future.result())
+
+
+def get_texts_to_parse(instance, all_corr_sents):
+    """Original and corrected sentences of the instance that are analyzed by spaCy in classify_changes"""
+    if all_corr_sents is None:
+        return []
+    orig_sentences = instance["annotations"]["basic_reader"]["extended_markup"]["clear_essay_sentences"]
+    curr_sentences = instance["annotations"]["contraction_corrector"]["essay_sentences"]
+    texts, offset = [], 0
+    for orig_paragraph, curr_paragraph in zip(orig_sentences, curr_sentences):
+        corr_sents = all_corr_sents[offset : offset + len(curr_paragraph)]
+        offset += len(curr_paragraph)
+        for orig_sent, _, corr_sent in zip(orig_paragraph, curr_paragraph, corr_sents):
+            texts.extend([orig_sent["text"], corr_sent])
+    return texts
+
+
+def handler(instance, all_corr_sents, parsed=None):
+    if not is_supported(instance):
         return {"selections": []}
     orig_essay = instance["annotations"]["basic_reader"]["standard_markup"]["text"]
     orig_sentences = instance["annotations"]["basic_reader"]["extended_markup"]["clear_essay_sentences"]
@@ -56,6 +100,7 @@ def handler(instance):
     # потом это станет спеллер
     curr_sentences = instance["annotations"]["contraction_corrector"]["essay_sentences"]
     corrections, corrected_sents, index_maps = [], [], []
+    offset = 0
     for i, curr_paragraph in enumerate(curr_sentences):
         if not curr_paragraph:
             corrected_sents.append([])
@@ -63,7 +108,8 @@ def handler(instance):
             continue
         corrected_paragraph_sents, paragraph_index_maps = [], []
         orig_paragraph = orig_sentences[i]
-        corr_sents = predict_corrections(curr_paragraph)  # skill_sents
+        corr_sents = all_corr_sents[offset : offset + len(curr_paragraph)]  # skill_sents
+        offset += len(curr_paragraph)
         for j, (orig_sent, curr_sent, corr_sent) in enumerate(zip(orig_paragraph, curr_paragraph, corr_sents)):
             curr_index_map = instance["annotations"]["contraction_corrector"]["index_map"][i][j]
             word_offsets = orig_offsets[i][j]
@@ -91,7 +137,18 @@ def handler(instance):
                     change_end += 1
                 elem[2], elem[4] = (change_start, change_end), corr_words[change_start:change_end]
             # сохраняем ответы
-            corrections.extend(classify_changes(new_opcodes, orig_sent["text"], corr_sent, word_bounds, orig_essay))
+            corrections.extend(
+                classify_changes(
+                    new_opcodes,
+                    orig_sent["text"],
+                    corr_sent,
+                    word_bounds,
+                    orig_essay,
+                    parsed,
+                    before_words=orig_sent["words"],
+                    after_words=corr_words,
+                )
+            )
             corrected_paragraph_sents.append({"text": corr_sent, "words": corr_words})
             paragraph_index_maps.append(orig_corr_index_map)
         corrected_sents.append(corrected_paragraph_sents)
@@ -121,12 +178,31 @@ def respond():
     if STORE_DATA_ENABLE:
         store.save2json_line(request.json, INPUT_DATA_FILE)
 
-    responses = [handler(instance) for instance in request.json["input_data"]]
+    input_data = request.json["input_data"]
+    futures = [submit_instance(instance) for instance in input_data]
+    corrected_sentences = [get_corrected_sentences(future) for future in futures]
+    # sentences of all instances are parsed by spaCy in one batch
+    texts = [
+        text
+        for instance, all_corr_sents in zip(input_data, corrected_sentences)
+        for text in get_texts_to_parse(instance, all_corr_sents)
+    ]
+    parsed = parse_sentences(texts)
+    responses = [
+        handler(instance, all_corr_sents, parsed)
+        for instance, all_corr_sents in zip(input_data, corrected_sentences)
+    ]
 
     total_time = time.time() - st_time
     logger.info(f"{SERVICE_NAME} exec time: {total_time:.3f}s")
     return jsonify(responses)
 
 
+@app.route("/cache_stats", methods=["GET"])
+def cache_stats():
+    """Hit rates of the gector caches"""
+    return jsonify(get_cache_stats())
+
+
 if __name__ == "__main__":
     app.run(debug=True, host="0.0.0.0", port=SERVICE_PORT)
@@ -2,4 +2,7 @@ while ! pip install -r common_requirements.txt ; do sleep 5; done
 
 python preload_gector.py
 
-gunicorn --workers=1 server:app -b 0.0.0.0:${SERVICE_PORT} --reload
\ No newline at end of file
+GECTOR_DICTIONARY_INDEX=${GECTOR_DICTIONARY_INDEX:-/root/.cache/gector/scowl_70.idx}
+[ -f $GECTOR_DICTIONARY_INDEX ] || python build_dictionary.py /data/dictionaries/scowl_70 $GECTOR_DICTIONARY_INDEX
+
+gunicorn --workers=1 --threads=${GECTOR_THREADS:-4} server:app -b 0.0.0.0:${SERVICE_PORT} --reload
\ No newline at end of file
@@ -1,4 +1,5 @@
 import os
+from itertools import zip_longest
 from pathlib import Path
 
 VOCAB_DIR = Path(__file__).resolve().parent.parent / "vocab"
@@ -145,6 +146,23 @@ def read_parallel_lines(fn1, fn2):
     return out_lines1, out_lines2
 
 
+def count_lines(fn):
+    with open(fn, "rb") as f:
+        return sum(1 for _ in f)
+
+
+def iter_parallel_lines(fn1, fn2):
+    """
+    Lazy version of ``read_parallel_lines``, yields the line number and the stripped lines of both files.
+    """
+    with open(fn1, "r", encoding="utf-8") as f1, open(fn2, "r", encoding="utf-8") as f2:
+        for i, (line1, line2) in enumerate(zip_longest(f1, f2), 1):
+            assert line1 is not None and line2 is not None, "files have different number of lines"
+            line1, line2 = line1.strip(), line2.strip()
+            if line1 and line2:
+                yield i, line1, line2
+
+
 def read_lines(fn, skip_strip=False):
     if not os.path.exists(fn):
         return []
@@ -1,5 +1,10 @@
 import argparse
+import json
+import os
 from difflib import SequenceMatcher
+from functools import partial
+from itertools import islice
+from multiprocessing import Pool
 
 import Levenshtein
 import numpy as np
@@ -7,52 +12,85 @@ from helpers import (
     SEQ_DELIMETERS,
     START_TOKEN,
     apply_reverse_transformation,
+    count_lines,
     encode_verb_form,
-    read_parallel_lines,
+    iter_parallel_lines,
     write_lines,
 )
 from tqdm import tqdm
 
 
-def perfect_align(t, T, insertions_allowed=0, cost_function=Levenshtein.distance):
+INF = int(1e9)
+
+
+def _get_span_costs(t, T, cost_function, max_span=None):
+    """
+    Costs of matching every token of ``t`` with every span ``T[j:j + d]`` and costs of inserting the spans,
+    the spans are stored by their length ``d``, so only the spans of at most ``max_span`` tokens are built.
+    ``match_costs[i, j, d]`` and ``insert_costs[j, d]`` are ``INF`` for the spans beyond the end of ``T``.
+    """
+    m = len(T)
+    width = m if max_span is None else min(max_span, m)
+    insert_costs = np.full((m + 1, width + 1), INF, dtype=np.int64)
+    match_costs = np.full((len(t), m + 1, width + 1), INF, dtype=np.int64)
+    spans = {(j, d): "   ".join(T[j : j + d]) for j in range(m + 1) for d in range(min(width, m - j) + 1)}
+    for (j, d), span in spans.items():
+        insert_costs[j, d] = len(span)
+    token_costs = {}
+    for i, token in enumerate(t):
+        if token not in token_costs:
+            costs = np.full((m + 1, width + 1), INF, dtype=np.int64)
+            for (j, d), span in spans.items():
+                costs[j, d] = 0 if apply_transformation(token, span) else cost_function(token, span)
+            token_costs[token] = costs
+        match_costs[i] = token_costs[token]
+    return match_costs, insert_costs
+
+
+def perfect_align(t, T, insertions_allowed=0, cost_function=Levenshtein.distance, max_span=None):
     # dp[i, j, k] is a minimal cost of matching first `i` tokens of `t` with
     # first `j` tokens of `T`, after making `k` insertions after last match of
     # token from `t`. In other words t[:i] aligned with T[:j].
+    # `max_span` optionally limits the number of tokens of `T` matched or inserted at once,
+    # the alignment is computed without the limit if `T` can not be covered by such spans.
 
     # Initialize with INFINITY (unknown)
-    shape = (len(t) + 1, len(T) + 1, insertions_allowed + 1)
-    dp = np.ones(shape, dtype=int) * int(1e9)
-    come_from = np.ones(shape, dtype=int) * int(1e9)
-    come_from_ins = np.ones(shape, dtype=int) * int(1e9)
+    m = len(T)
+    shape = (len(t) + 1, m + 1, insertions_allowed + 1)
+    dp = np.full(shape, INF, dtype=np.int64)
+    come_from = np.full(shape, INF, dtype=np.int64)
+    come_from_ins = np.full(shape, INF, dtype=np.int64)
+    match_costs, insert_costs = _get_span_costs(t, T, cost_function, max_span)
+    width = insert_costs.shape[1] - 1
 
     dp[0, 0, 0] = 0  # The only known starting point. Nothing matched to nothing.
+    # The relaxations are vectorized over the start `j` of the span for every span length `d`.
+    # Ties are resolved in favour of the first source state in the (j, q) order, as in the loop
+    # over all (i, j, q, k): the lengths go from the longest, so the starts of a target `k` go up.
     for i in range(len(t) + 1):  # Go inclusive
-        for j in range(len(T) + 1):  # Go inclusive
-            for q in range(insertions_allowed + 1):  # Go inclusive
-                if i < len(t):
-                    # Given matched sequence of t[:i] and T[:j], match token
-                    # t[i] with following tokens T[j:k].
-                    for k in range(j, len(T) + 1):
-                        transform = apply_transformation(t[i], "   ".join(T[j:k]))
-                        if transform:
-                            cost = 0
-                        else:
-                            cost = cost_function(t[i], "   ".join(T[j:k]))
-                        current = dp[i, j, q] + cost
-                        if dp[i + 1, k, 0] > current:
-                            dp[i + 1, k, 0] = current
-                            come_from[i + 1, k, 0] = j
-                            come_from_ins[i + 1, k, 0] = q
-                if q < insertions_allowed:
-                    # Given matched sequence of t[:i] and T[:j], create
-                    # insertion with following tokens T[j:k].
-                    for k in range(j, len(T) + 1):
-                        cost = len("   ".join(T[j:k]))
-                        current = dp[i, j, q] + cost
-                        if dp[i, k, q + 1] > current:
-                            dp[i, k, q + 1] = current
-                            come_from[i, k, q + 1] = j
-                            come_from_ins[i, k, q + 1] = q
+        for q in range(insertions_allowed):
+            # Given matched sequence of t[:i] and T[:j], create
+            # insertion with following tokens T[j:j + d].
+            for d in range(width, -1, -1):
+                current = dp[i, : m + 1 - d, q] + insert_costs[: m + 1 - d, d]
+                (update,) = np.nonzero(current < dp[i, d:, q + 1])
+                dp[i, update + d, q + 1] = current[update]
+                come_from[i, update + d, q + 1] = update
+                come_from_ins[i, update + d, q + 1] = q
+        if i < len(t):
+            # Given matched sequence of t[:i] and T[:j], match token
+            # t[i] with following tokens T[j:j + d].
+            for d in range(width, -1, -1):
+                current = dp[i, : m + 1 - d, :] + match_costs[i, : m + 1 - d, d, None]
+                best_q = current.argmin(axis=1)
+                best = current[np.arange(m + 1 - d), best_q]
+                (update,) = np.nonzero(best < dp[i + 1, d:, 0])
+                dp[i + 1, update + d, 0] = best[update]
+                come_from[i + 1, update + d, 0] = update
+                come_from_ins[i + 1, update + d, 0] = best_q[update]
+
+    if max_span is not None and dp[len(t), m].min() >= INF:
+        return perfect_align(t, T, insertions_allowed, cost_function)
 
     # Solution is in the dp[len(t), len(T), *]. Backtracking from there.
     alignment = []
@@ -186,7 +224,7 @@ def apply_transformation(source_token, target_token):
     return None
 
 
-def align_sequences(source_sent, target_sent):
+def align_sequences(source_sent, target_sent, max_span=None):
     # check if sent is OK
     if not is_sent_ok(source_sent) or not is_sent_ok(target_sent):
         return None
@@ -219,7 +257,7 @@ def align_sequences(source_sent, target_sent):
                 continue
 
             # normalize alignments if need (make them singleton)
-            _, alignments = perfect_align(source_part, target_part, insertions_allowed=0)
+            _, alignments = perfect_align(source_part, target_part, insertions_allowed=0, max_span=max_span)
             for alignment in alignments:
                 new_shift = alignment[2][0]
                 edits = convert_alignments_into_edits(alignment, shift_idx=i1 + new_shift)
@@ -322,43 +360,112 @@ def add_labels_to_the_tokens(source_tokens, labels, delimeters=SEQ_DELIMETERS):
     return delimeters["tokens"].join(tokens_with_all_tags)
 
 
-def convert_data_from_raw_files(source_file, target_file, output_file, chunk_size):
-    tagged = []
-    source_data, target_data = read_parallel_lines(source_file, target_file)
-    print(f"The size of raw dataset is {len(source_data)}")
-    cnt_total, cnt_all, cnt_tp = 0, 0, 0
-    for source_sent, target_sent in tqdm(zip(source_data, target_data)):
-        try:
-            aligned_sent = align_sequences(source_sent, target_sent)
-        except Exception:
-            aligned_sent = align_sequences(source_sent, target_sent)
-        if source_sent != target_sent:
-            cnt_tp += 1
-        alignments = [aligned_sent]
-        cnt_all += len(alignments)
-        try:
-            check_sent = convert_tagged_line(aligned_sent)
-        except Exception:
-            # debug mode
-            aligned_sent = align_sequences(source_sent, target_sent)
-            check_sent = convert_tagged_line(aligned_sent)
-
-        if "".join(check_sent.split()) != "".join(target_sent.split()):
-            # do it again for debugging
-            aligned_sent = align_sequences(source_sent, target_sent)
-            check_sent = convert_tagged_line(aligned_sent)
-            print(f"Incorrect pair: \n{target_sent}\n{check_sent}")
-            continue
-        if alignments:
-            cnt_total += len(alignments)
-            tagged.extend(alignments)
-        if len(tagged) > chunk_size:
+def align_pair(pair, max_span=None):
+    """
+    Aligns a pair of sentences and checks that the labels restore the target sentence.
+    ``max_span`` limits the number of target tokens aligned with a source token, see ``perfect_align``.
+    Returns the line number, the status (``ok``, ``incorrect`` or ``error``) and the tagged line or the error.
+    """
+    line_number, source_sent, target_sent = pair
+    try:
+        aligned_sent = align_sequences(source_sent, target_sent, max_span=max_span)
+        if aligned_sent is None:
+            return line_number, "error", "the sentence contains delimiters"
+        check_sent = convert_tagged_line(aligned_sent)
+    except Exception as e:
+        return line_number, "error", repr(e)
+    if "".join(check_sent.split()) != "".join(target_sent.split()):
+        return line_number, "incorrect", check_sent
+    return line_number, "ok", aligned_sent
+
+
+def _read_checkpoint(checkpoint_file):
+    if not os.path.exists(checkpoint_file):
+        return None
+    with open(checkpoint_file, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _write_checkpoint(checkpoint_file, checkpoint):
+    tmp_file = f"{checkpoint_file}.tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_file, checkpoint_file)
+
+
+def convert_data_from_raw_files(
+    source_file, target_file, output_file, chunk_size, workers=1, resume=False, max_span=None
+):
+    """
+    Streams the parallel corpus in chunks of ``chunk_size`` pairs, aligns each chunk with a pool of ``workers``
+    processes and appends the tagged lines to ``output_file`` in the order of the corpus.
+    The pairs that can not be aligned are written to ``{output_file}.failures``.
+    ``max_span`` limits the number of target tokens aligned with a source token to speed up long replacements.
+    After each chunk the progress is saved to ``{output_file}.checkpoint``, so that ``resume`` continues from it,
+    a run without ``resume`` starts the output, the failures and the checkpoint anew.
+    """
+    # the files are checked before anything is written, as when they were read completely
+    assert count_lines(source_file) == count_lines(target_file), "files have different number of lines"
+    failures_file = f"{output_file}.failures"
+    checkpoint_file = f"{output_file}.checkpoint"
+    checkpoint = _read_checkpoint(checkpoint_file) if resume else None
+    if checkpoint is None:
+        checkpoint = {"pairs": 0, "output_size": 0, "failures_size": 0, "total": 0, "all": 0, "tp": 0}
+        for fn in [output_file, failures_file, checkpoint_file]:
+            if os.path.exists(fn):
+                os.remove(fn)
+    else:
+        # drop the lines written after the checkpoint
+        for fn, size in [(output_file, checkpoint["output_size"]), (failures_file, checkpoint["failures_size"])]:
+            if os.path.exists(fn):
+                with open(fn, "r+b") as f:
+                    f.truncate(size)
+        print(f"Resuming after {checkpoint['pairs']} pairs")
+
+    pairs = islice(iter_parallel_lines(source_file, target_file), checkpoint["pairs"], None)
+    align = partial(align_pair, max_span=max_span)
+    pool = Pool(workers) if workers > 1 else None
+    progress = tqdm(initial=checkpoint["pairs"])
+    try:
+        for chunk in iter(lambda: list(islice(pairs, chunk_size)), []):
+            if pool is not None:
+                results = pool.map(align, chunk, chunksize=max(1, len(chunk) // (workers * 4)))
+            else:
+                results = list(map(align, chunk))
+            tagged, failures = [], []
+            for (_, source_sent, target_sent), (line_number, status, result) in zip(chunk, results):
+                checkpoint["all"] += 1
+                checkpoint["tp"] += source_sent != target_sent
+                if status == "ok":
+                    checkpoint["total"] += 1
+                    tagged.append(result)
+                else:
+                    failure = {
+                        "line": line_number,
+                        "status": status,
+                        "result": result,
+                        "source": source_sent,
+                        "target": target_sent,
+                    }
+                    failures.append(json.dumps(failure, ensure_ascii=False))
             write_lines(output_file, tagged, mode="a")
-            tagged = []
-
-    print(f"Overall extracted {cnt_total}. " f"Original TP {cnt_tp}." f" Original TN {cnt_all - cnt_tp}")
-    if tagged:
-        write_lines(output_file, tagged, "a")
+            write_lines(failures_file, failures, mode="a")
+            checkpoint["pairs"] += len(chunk)
+            checkpoint["output_size"] = os.path.getsize(output_file)
+            checkpoint["failures_size"] = os.path.getsize(failures_file)
+            _write_checkpoint(checkpoint_file, checkpoint)
+            progress.update(len(chunk))
+    finally:
+        progress.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    print(
+        f"Overall extracted {checkpoint['total']}. "
+        f"Original TP {checkpoint['tp']}."
+        f" Original TN {checkpoint['all'] - checkpoint['tp']}"
+    )
 
 
 def convert_labels_into_edits(labels):
@@ -456,7 +563,15 @@ def convert_tagged_line(line, delimeters=SEQ_DELIMETERS):
 
 
 def main(args):
-    convert_data_from_raw_files(args.source, args.target, args.output_file, args.chunk_size)
+    convert_data_from_raw_files(
+        args.source,
+        args.target,
+        args.output_file,
+        args.chunk_size,
+        workers=args.workers,
+        resume=args.resume,
+        max_span=args.max_span,
+    )
 
 
 if __name__ == "__main__":
@@ -465,5 +580,10 @@ if __name__ == "__main__":
     parser.add_argument("-t", "--target", help="Path to the target file", required=True)
     parser.add_argument("-o", "--output_file", help="Path to the output file", required=True)
     parser.add_argument("--chunk_size", type=int, help="Dump each chunk size.", default=1000000)
+    parser.add_argument("--workers", type=int, help="Number of alignment processes.", default=os.cpu_count())
+    parser.add_argument("--resume", action="store_true", help="Continue from the checkpoint of the output file.")
+    parser.add_argument(
+        "--max_span", type=int, help="Max number of target tokens aligned with a source token.", default=None
+    )
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,162 @@
+import json
+import os
+import random
+import tempfile
+
+import Levenshtein
+import preprocess_data
+from helpers import write_lines
+from preprocess_data import apply_transformation, convert_data_from_raw_files, perfect_align
+
+WORDS = ["go", "went", "goes", "Go", "GO", "run", "ran", "cat", "cats", "a", "an", "the", "well-known", "well", "known"]
+
+
+def _match_cost(token, span):
+    return 0 if apply_transformation(token, span) else Levenshtein.distance(token, span)
+
+
+def _loop_align_cost(t, T, insertions_allowed, max_span=None):
+    # the dynamic programming over all (i, j, q, k) replaced by the vectorized one
+    dp = {(0, 0, 0): 0}
+    for i in range(len(t) + 1):
+        for j in range(len(T) + 1):
+            for q in range(insertions_allowed + 1):
+                if (i, j, q) not in dp:
+                    continue
+                for k in range(j, len(T) + 1 if max_span is None else min(len(T), j + max_span) + 1):
+                    span = "   ".join(T[j:k])
+                    if i < len(t):
+                        cost = dp[i, j, q] + _match_cost(t[i], span)
+                        dp[i + 1, k, 0] = min(dp.get((i + 1, k, 0), cost), cost)
+                    if q < insertions_allowed:
+                        cost = dp[i, j, q] + len(span)
+                        dp[i, k, q + 1] = min(dp.get((i, k, q + 1), cost), cost)
+    costs = [dp[len(t), len(T), q] for q in range(insertions_allowed + 1) if (len(t), len(T), q) in dp]
+    return min(costs, default=None)
+
+
+def _alignment_cost(t, T, alignment):
+    # the alignment covers both sequences in order and its cost is the sum of the costs of its steps
+    assert [target for _, span, _ in alignment for target in span] == T
+    assert [i for operation, _, (i, _) in alignment if operation != "INSERT"] == list(range(len(t)))
+    cost = 0
+    for operation, span, (i, _) in alignment:
+        span = "   ".join(span)
+        cost += len(span) if operation == "INSERT" else _match_cost(t[i], span)
+    return cost
+
+
+def test_perfect_align():
+    rng = random.Random(0)
+    for _ in range(500):
+        t = [rng.choice(WORDS) for _ in range(rng.randint(0, 5))]
+        T = [rng.choice(WORDS) for _ in range(rng.randint(0, 6))]
+        insertions_allowed = rng.randint(0, 2)
+        if not t and T and not insertions_allowed:
+            # the target can not be matched without insertions
+            continue
+        cost, alignment = perfect_align(t, T, insertions_allowed)
+        assert cost == _loop_align_cost(t, T, insertions_allowed), (t, T, insertions_allowed)
+        assert cost == _alignment_cost(t, T, alignment), (t, T, insertions_allowed)
+        assert perfect_align(t, T, insertions_allowed, max_span=len(T) + 1) == (cost, alignment)
+        for max_span in [0, 1, 2]:
+            # the spans are limited if the target can be covered by them
+            expected = _loop_align_cost(t, T, insertions_allowed, max_span)
+            expected = cost if expected is None else expected
+            banded_cost, banded_alignment = perfect_align(t, T, insertions_allowed, max_span=max_span)
+            assert banded_cost == expected == _alignment_cost(t, T, banded_alignment), (t, T, max_span)
+
+
+def test_perfect_align_example():
+    t = "the cats goes to the well known place".split()
+    T = "the cat went to a well-known place quickly".split()
+    cost, alignment = perfect_align(t, T, insertions_allowed=1)
+    assert cost == _loop_align_cost(t, T, 1) == 23
+    assert [(operation, span) for operation, span, _ in alignment] == [
+        ("REPLACE_the", ["the"]),
+        ("REPLACE_cats", ["cat"]),
+        ("REPLACE_goes", ["went"]),
+        ("REPLACE_to", ["to"]),
+        ("REPLACE_the", []),
+        ("REPLACE_well", ["a"]),
+        ("REPLACE_known", ["well-known"]),
+        ("REPLACE_place", ["place"]),
+        ("INSERT", ["quickly"]),
+    ]
+
+
+def _read(path):
+    with open(path, encoding="utf-8") as f:
+        return f.read()
+
+
+def test_resume():
+    rng = random.Random(0)
+    source = [" ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 6))) for _ in range(20)]
+    target = [" ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 6))) for _ in range(20)]
+    # an empty pair is skipped and a pair with the delimiters is a failure
+    source[4], target[4] = "", "cat"
+    source[9] = "the SEPL|||SEPR cat"
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source_file, target_file = os.path.join(tmp_dir, "source.txt"), os.path.join(tmp_dir, "target.txt")
+        write_lines(source_file, source)
+        write_lines(target_file, target)
+        expected_file = os.path.join(tmp_dir, "expected.txt")
+        convert_data_from_raw_files(source_file, target_file, expected_file, chunk_size=3)
+
+        output_file = os.path.join(tmp_dir, "output.txt")
+        # the files of an unrelated run are replaced by a run without resume
+        write_lines(output_file, ["stale line"])
+        write_lines(f"{output_file}.checkpoint", ['{"pairs": 100, "output_size": 1}'])
+        align_pair = preprocess_data.align_pair
+
+        def failing_align_pair(pair, max_span=None):
+            if pair[0] == 14:
+                raise KeyboardInterrupt()
+            return align_pair(pair, max_span)
+
+        preprocess_data.align_pair = failing_align_pair
+        try:
+            convert_data_from_raw_files(source_file, target_file, output_file, chunk_size=3)
+        except KeyboardInterrupt:
+            pass
+        else:
+            raise AssertionError("the conversion is not interrupted")
+        finally:
+            preprocess_data.align_pair = align_pair
+        assert json.loads(_read(f"{output_file}.checkpoint"))["pairs"] == 12
+        # the lines of the interrupted chunk are dropped on resume
+        write_lines(output_file, ["partially written line"], mode="a")
+        convert_data_from_raw_files(source_file, target_file, output_file, chunk_size=3, resume=True)
+
+        assert _read(output_file) == _read(expected_file)
+        assert _read(f"{output_file}.failures") == _read(f"{expected_file}.failures")
+        checkpoint = json.loads(_read(f"{output_file}.checkpoint"))
+        expected_checkpoint = json.loads(_read(f"{expected_file}.checkpoint"))
+        assert checkpoint["pairs"] == expected_checkpoint["pairs"] == 19
+        for key in ["total", "all", "tp"]:
+            assert checkpoint[key] == expected_checkpoint[key], key
+        assert [json.loads(line)["line"] for line in _read(f"{output_file}.failures").splitlines()] == [10]
+
+
+
+def test_different_number_of_lines():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source_file, target_file = os.path.join(tmp_dir, "source.txt"), os.path.join(tmp_dir, "target.txt")
+        write_lines(source_file, ["a cat", "the cats", "go"])
+        write_lines(target_file, ["a cat", "the cat"])
+        output_file = os.path.join(tmp_dir, "output.txt")
+        try:
+            convert_data_from_raw_files(source_file, target_file, output_file, chunk_size=1)
+        except AssertionError:
+            pass
+        else:
+            raise AssertionError("files of different length are converted")
+        assert not os.path.exists(output_file) and not os.path.exists(f"{output_file}.checkpoint")
+
+
+if __name__ == "__main__":
+    test_perfect_align()
+    test_perfect_align_example()
+    test_resume()
+    test_different_number_of_lines()
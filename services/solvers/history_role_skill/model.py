@@ -1,7 +1,6 @@
 from collections import defaultdict
-from io import StringIO
 
-from udapi.block.read.conllu import Conllu
+from cp_conllu.tree import Tree
 
 
 def count_entities(parses, labels, entity_type=None, use_lemmas=False):
@@ -26,10 +25,7 @@ def count_entities(parses, labels, entity_type=None, use_lemmas=False):
 
 def detect_roles(parses, ner_labels, sents=None, context_length=1, min_person_count=1, return_sentence_indexes=False):
     prelim_answer = defaultdict(list)
-    if len(parses) > 0 and isinstance(parses[0], list):
-        parses = ["\n".join("\t".join(elem) for elem in parse) for parse in parses]
-    if len(parses) > 0 and isinstance(parses[0], str):
-        parses = [Conllu(filehandle=StringIO(parse)).read_tree().descendants for parse in parses]
+    parses = [Tree.from_parse(parse).descendants for parse in parses]
     if sents is None:
         sents = [" ".join(node.form for node in sent_parse) for sent_parse in parses]
     entity_counts = count_entities(parses, ner_labels, entity_type="PER", use_lemmas=True)